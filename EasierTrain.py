@@ -34,12 +34,32 @@
 '''
 import sys
 import edge
+import regions
+import imagestore
+import pixelbuffer
+import threading
+import fieldcache
+import colorstats
 import Image # PIL
-import os
 import Tkinter as tk
 import ImageTk
 import generator
-import pickle # serialization
+import session
+import workers
+import thumbnails
+import numpy
+import instrument
+import pyramid
+
+# How many pictures on each side of the current one are got ready
+# in the background
+PREFETCH = 2
+
+# Threshold of pictures that haven't been given one
+DEFAULT_THRESHOLD = 250
+
+# How often the background tasks are checked on, in milliseconds
+POLL = 100
 
 class EasierTrain(tk.Tk):
     '''
@@ -60,38 +80,64 @@ class EasierTrain(tk.Tk):
 
         self.img = None # stores the current image
         self.w, self.h = None, None # width and height of the current image
+        self.magnitude = None # gradient magnitude of the current image
+        self.edge_threshold = None # threshold shown in self.edge_img
+        self.level = 0 # pyramid level the current image is shown at
+        self.edges = None # boolean edge map at self.edge_threshold
+        self.tree = None # component tree of self.magnitude, made when needed
         self.edge_img = None # edge detection output
         self.pic = None # printed to self.canvas
         self.edge_pic = None # printed to self.canvas
+        self.pic_item = None # canvas item showing self.pic
+        self.edge_item = None # canvas item showing self.edge_pic
 
         self.img_index = 0 # stores the place of the current image in imgpaths
         self.img_path = '' # stores the path of the current image
         self.highlight_area = dict() # stores the active area selection
+        self.highlight_seeds = dict() # points clicked to make the selection
+        self.highlight_stats = dict() # colorstats of each area of the selection
+        self.selected = dict() # tree node : (area, stats) of the current image
         self.master_color_list = [] # stores all the data for added colors
 
-        self.highlight_img = None # image data for current selection
-        self.highlight_pic = None # printed to self.canvas
+        self.highlight_img = None # image data for the last redrawn box
+        self.painted_box = None # box around the areas colored in edge_pic
         self.canvas = None
 
-        #Populates self.imgpaths with full paths to images in the directory
-        for item in os.listdir(imgdir):
-            relpath = os.path.join(imgdir,item)
-
-            #Omit directories
-            if os.path.isdir( relpath ):
-                print "Omitting directory", relpath
-                continue
-
+        # Pictures around the current one are decoded and edge detected in
+        # the background, into
+        #   self.prepared = { path : (threshold, pixels, magnitude,
+        #                             edges, edge_img) }
+        self.prefetcher = workers.WorkerPool()
+        self.prepared = dict()
+
+        # Slow work the user is waiting on runs as tasks in the background,
+        # with how far along it is shown in the toolbox
+        self.tasks = workers.TaskRunner( 2 )
+        self.edgeTask = None # finding the edges of the current picture
+        self.treeTask = None # building the component tree of the current picture
+        self.saveTask = None # making the .tm/.col files and saving the session
+        self.paletteTask = None # adding the selection to the palette
+        self.saving = threading.Lock() # held while the files are made
+
+        # Populates self.imgpaths with full paths to images in the directory.
+        # Only the first picture is looked for now so it can be shown
+        # straight away, the rest are found in the background.
+        found = imagestore.pictures( imgdir )
+        for relpath in found:
             #Weed out files that are not compatible with PIL
             try:
-                tmpImg = Image.open( relpath )
+                Image.open( relpath )
             except(IOError):
                 print "Not a compatible image file", relpath
                 continue
 
-            print "Loading file", relpath
             self.imgpaths.append( relpath )
-            self.thresholds[relpath] = 250
+            break
+
+        self.scanner = threading.Thread( target=self.scanPictures,\
+                                         args=(imgdir, found) )
+        self.scanner.setDaemon( True )
+        self.scanner.start()
 
         if len(self.imgpaths) != 0:
             self.img_path = self.imgpaths[0]
@@ -124,7 +170,6 @@ class EasierTrain(tk.Tk):
 
         #TODO Prevent Toplevel() windows from being closed?
         #TODO combine toolbox and scalebox?
-        #TODO image thumbnails window
         self.toolbox = tk.Toplevel()
         self.toolbox.title( "Toolbox" )
 
@@ -137,15 +182,20 @@ class EasierTrain(tk.Tk):
         self.scale = tk.Scale( self.scalebox,\
                                from_=0, to=2500,\
                                sliderlength=10,\
-                               length=250 )
-        self.scale.set( 250 ) # Scale value referenced in drawImg()
+                               length=250,\
+                               command=self.OnScaleMove )
+        self.scale.set( DEFAULT_THRESHOLD ) # Scale value referenced in drawImg()
+
+        # Says whether the picture is shown at full size or as a preview
+        self.levelLabel = tk.Label( self.scalebox, text='' )
+        self.levelLabel.grid( column=0, row=2, columnspan=2 )
 
         # Draw the picture to the canvas
         self.drawImg()
 
         self.scale.grid( column=0, row=0, columnspan=2 )
 
-        # Event for adjusting the scale slider
+        # Event for letting go of the scale slider
         self.scale.bind( "<ButtonRelease-1>", self.OnScaleRelease )
 
         # Text entry and button for manual threshold input
@@ -181,11 +231,38 @@ class EasierTrain(tk.Tk):
                                              command=self.OnQuitClick )
         self.quit.grid( column=3, row=1, padx=2, pady=3 )
 
+        # Thumbnails of all the pictures, to jump straight to one
+        self.thumbs = tk.Button( self.toolbox, text='Pictures',\
+                                               command=self.OnThumbnailsClick )
+        self.thumbs.grid( column=1, row=2, padx=2, pady=3 )
+        self.browser = None
+
+        # What the background tasks are doing, and a button to stop them
+        self.cancelBtn = tk.Button( self.toolbox, text='Cancel',\
+                                                  state='disabled',\
+                                                  command=self.OnCancelClick )
+        self.cancelBtn.grid( column=2, row=2, padx=2, pady=3 )
+        self.progressLabel = tk.Label( self.toolbox, text='', width=30,\
+                                                     anchor='w' )
+        self.progressLabel.grid( column=1, row=3, columnspan=3, sticky='W' )
+        self.pollTasks()
+
         # Delete button for color palette
         self.deleteBtn = tk.Button( self.palette, text='Delete',\
                                                command=self.OnDeleteClick )
         self.deleteBtn.grid( column=0, row=0 )
 
+    def scanPictures(self, imgdir, found):
+        '''
+            Adds the rest of the pictures of the directory to self.imgpaths.
+            Runs on its own thread while the first picture is shown.
+            Files are only checked by their header here; any that PIL
+            can't read after all are left out when they are first shown.
+        '''
+        for relpath in found:
+            self.imgpaths.append( relpath )
+        print "Found", len(self.imgpaths), "pictures in", imgdir
+
     def rgbTupleToHex(self, RGB):
         '''
             Takes an integer tuple of the form (R,G,B)
@@ -211,39 +288,204 @@ class EasierTrain(tk.Tk):
 
         return hexcol
 
+    @instrument.timed( "show picture" )
     def drawImg(self):
         '''
             Draws the current image to the screen.
         '''
         
-        self.img = Image.open( self.img_path )
-        self.pixels = list( self.img.getdata() )
+        # Whatever was still being worked out for the last picture
+        # is of no use now
+        for task in ( self.edgeTask, self.treeTask ):
+            if task is not None:
+                task.cancel()
+        self.edgeTask, self.treeTask = None, None
+        self.tree = None
+        self.selected = dict()
+
+        self.edge_threshold = self.scale.get()
+        prepared = self.prepared.get( self.img_path )
+
+        # Big pictures are shown and worked on at a smaller pyramid level
+        self.level = pyramid.picture_level( self.img_path )
+
+        if prepared is None:
+            self.pixels = pyramid.level_pixels( self.img_path, self.level )
+            # The magnitude is kept so that a new threshold is only a
+            # comparison. If it isn't cached, it is found in the background.
+            self.magnitude = fieldcache.cached_gradient( self.img_path,\
+                                                         self.level )
+            self.edges, self.edge_img = None, None
+            if self.magnitude is not None:
+                self.thresholdEdges()
+        else:
+            threshold, self.pixels, self.magnitude, self.edges, self.edge_img\
+                = prepared
+            if threshold != self.edge_threshold:
+                self.thresholdEdges()
+
+        self.img = Image.fromarray( self.pixels.rgb() )
         self.w, self.h = self.img.size
-        self.edge_img = edge.prewitt( self.pixels,\
-                                      self.w, self.h,\
-                                      self.scale.get() )
-
-        # Just make a new canvas each time the current image is changed
-        if self.canvas != None:
-            self.canvas.grid_remove()
-        self.canvas = tk.Canvas( self.master, width=self.w*2, height=self.h )
-        self.canvas.grid( column=0, row=0,\
-                          columnspan=self.w/10,rowspan=self.h/10, sticky='NW' )
-
-        # Rebind events to the new canvas
-        self.canvas.bind( "<Button-1>", self.OnCanvasClick )
-        self.canvas.bind( "<Shift-Button-1>", self.OnCanvasShiftClick )
-        self.canvas.bind( "<Control-Button-1>", self.OnCanvasControlClick )
-
-        # Draw the picture
-        self.pic = ImageTk.PhotoImage(self.img)
-        self.canvas.create_image( 0, 0, image=self.pic, anchor='nw' )
-
-        # Draw the edge picture
-        self.edge_pic = ImageTk.PhotoImage(self.edge_img)
-        self.canvas.create_image( self.w, 0, image=self.edge_pic, anchor='nw' )
-        
-        self.edge_pixels = list( self.edge_img.getdata() )
+        if self.level == 0:
+            self.levelLabel.config( text="Full size" )
+        else:
+            self.levelLabel.config( text="Preview at 1/%d size, exact on Add"\
+                                         % (1 << self.level) )
+
+        edge_img = self.edge_img
+        if edge_img is None:
+            # Blank until the edges are found
+            edge_img = edge.edge_image( numpy.zeros( (self.h, self.w), bool ) )
+
+        # The canvas and its two image items are made once and kept
+        # for every picture, so the events are only bound once
+        if self.canvas == None:
+            self.canvas = tk.Canvas( self.master )
+            self.canvas.bind( "<Button-1>", self.OnCanvasClick )
+            self.canvas.bind( "<Shift-Button-1>", self.OnCanvasShiftClick )
+            self.canvas.bind( "<Control-Button-1>", self.OnCanvasControlClick )
+            self.pic_item = self.canvas.create_image( 0, 0, anchor='nw' )
+            self.edge_item = self.canvas.create_image( 0, 0, anchor='nw' )
+
+        # PhotoImages are where Tk gets its own copy of the pixels
+        with instrument.span( "photo" ):
+            if self.pic != None and\
+               (self.pic.width(), self.pic.height()) == (self.w, self.h):
+                # Same size as the last picture, so draw over the old ones
+                self.pic.paste(self.img)
+                self.edge_pic.paste(edge_img)
+            else:
+                self.canvas.config( width=self.w*2, height=self.h )
+                self.canvas.grid( column=0, row=0,\
+                                  columnspan=self.w/10,rowspan=self.h/10,\
+                                  sticky='NW' )
+                self.canvas.coords( self.edge_item, self.w, 0 )
+
+                # Draw the picture
+                self.pic = ImageTk.PhotoImage(self.img)
+                self.canvas.itemconfig( self.pic_item, image=self.pic )
+
+                # Draw the edge picture
+                self.edge_pic = ImageTk.PhotoImage(edge_img)
+                self.canvas.itemconfig( self.edge_item, image=self.edge_pic )
+        self.painted_box = None
+
+        if self.edges is None:
+            self.findEdges()
+        self.prefetch()
+
+    def thresholdEdges(self):
+        '''
+            Thresholds the gradient magnitude of the current picture at the
+            value of the scale widget, into self.edges and self.edge_img.
+        '''
+        self.edge_threshold = self.scale.get()
+        self.edges = edge.edges( self.magnitude, self.edge_threshold )
+        self.edge_img = edge.edge_image( self.edges )
+        self.prepared[self.img_path] = ( self.edge_threshold, self.pixels,\
+                                         self.magnitude, self.edges,\
+                                         self.edge_img )
+
+    def findEdges(self):
+        '''
+            Starts finding the edges of the current picture in the
+            background, unless that is already going on.
+        '''
+        if self.edgeTask is None or self.edgeTask.cancelled:
+            self.edgeTask = self.tasks.start( "Finding edges", self.edgesWork,\
+                                              self.edgesDone, self.img_path,\
+                                              self.level )
+
+    def edgesWork(self, progress, path, level):
+        '''
+            Finds the gradient magnitude of a pyramid level of a picture.
+            Runs on a worker thread, so it must not touch any widgets.
+        '''
+        return path, fieldcache.gradient( path, level )
+
+    def edgesDone(self, result):
+        '''
+            Shows the edges found by edgesWork(), and the areas of the
+            picture that were selected before.
+        '''
+        path, magnitude = result
+        self.edgeTask = None
+        if path != self.img_path:
+            return
+        self.magnitude = magnitude
+        self.thresholdEdges()
+        self.edge_pic.paste(self.edge_img)
+        self.painted_box = None
+        self.drawHighlight()
+
+    def pollTasks(self):
+        '''
+            Hands the results of finished tasks back to the GUI and shows
+            what the running ones are doing. Runs every POLL milliseconds.
+        '''
+        self.tasks.deliver()
+        status = self.tasks.status()
+        self.progressLabel.config( text=status )
+        if status:
+            self.cancelBtn.config( state='normal' )
+        else:
+            self.cancelBtn.config( state='disabled' )
+        self.after( POLL, self.pollTasks )
+
+    def OnCancelClick(self):
+        '''
+            Stops every background task. Edges that weren't found yet are
+            looked for again when the threshold is changed, and areas at
+            the next click.
+        '''
+        self.tasks.cancel()
+
+    def prefetch(self):
+        '''
+            Starts getting the pictures around the current one ready in the
+            background, and forgets the ones that are further away.
+            Anything still queued for the old neighbours is cancelled.
+        '''
+        wanted = []
+        for step in xrange( 1, PREFETCH+1 ):
+            for index in ( self.img_index+step, self.img_index-step ):
+                path = self.imgpaths[index % len(self.imgpaths)]
+                if path != self.img_path and path not in wanted:
+                    wanted.append( path )
+
+        for path in self.prepared.keys():
+            if path != self.img_path and path not in wanted:
+                del self.prepared[path]
+
+        self.prefetcher.cancel()
+        for path in wanted:
+            threshold = self.thresholds.setdefault( path, DEFAULT_THRESHOLD )
+            prepared = self.prepared.get( path )
+            if prepared is None or prepared[0] != threshold:
+                self.prefetcher.submit( self.prepare, path, threshold,\
+                                        self.prefetcher.generation )
+
+    def prepare(self, path, threshold, generation):
+        '''
+            Decodes a picture and finds its edges at the threshold.
+            Runs on a worker thread, so it must not touch any widgets.
+            The result is dropped if the user has moved on in the meantime.
+        '''
+        try:
+            level = pyramid.picture_level( path )
+            pixels = pyramid.level_pixels( path, level )
+            pixels.rgb() # decode it now, not on the Tk thread
+            if self.prefetcher.cancelled( generation ):
+                return
+            magnitude = fieldcache.gradient( path, level )
+        except(IOError):
+            return # found out about when it is shown
+
+        edges = edge.edges( magnitude, threshold )
+        edge_img = edge.edge_image( edges )
+        if not self.prefetcher.cancelled( generation ):
+            self.prepared[path] = ( threshold, pixels, magnitude,\
+                                    edges, edge_img )
 
     def drawPalette(self):
         '''
@@ -264,141 +506,250 @@ class EasierTrain(tk.Tk):
             self.colorNameInputs[i].grid( column=j*3+1, row=i%10 )
             self.colorFrames[i].grid( column=j*3+2, row=i%10 )
 
+    def updateSelection(self, full=False):
+        '''
+            Finds the areas around the clicked points again and draws them,
+            see drawHighlight() for full. The component tree of the picture
+            is loaded from the field cache the first time; if it isn't
+            there, it is built in the background and the areas are found
+            once it is ready.
+        '''
+        if self.tree is None and self.magnitude is not None:
+            self.tree = fieldcache.cached_component_tree( self.img_path,\
+                                                          self.magnitude,\
+                                                          self.level )
+            if self.tree is None and ( self.treeTask is None or\
+                                       self.treeTask.cancelled ):
+                self.treeTask = self.tasks.start( "Finding areas",\
+                                                  self.treeWork,\
+                                                  self.treeDone,\
+                                                  self.img_path,\
+                                                  self.magnitude,\
+                                                  self.level )
+        if self.tree is not None:
+            self.reselect()
+        self.drawHighlight( full )
+
+    def treeWork(self, progress, path, magnitude, level):
+        '''
+            Builds the component tree of a pyramid level of a picture.
+            Runs on a worker thread, so it must not touch any widgets.
+        '''
+        return path, fieldcache.component_tree( path, magnitude, progress,\
+                                                level )
+
+    def treeDone(self, result):
+        '''
+            Takes the tree built by treeWork() and selects the areas around
+            the points clicked while it was being built.
+        '''
+        path, tree = result
+        self.treeTask = None
+        if path != self.img_path:
+            return
+        self.tree = tree
+        self.updateSelection()
+
+    def clickedPoint(self, event):
+        '''
+            Returns the (x,y) point of the shown pyramid level of the image
+            under the mouse event, or None if the event was on an edge,
+            off the two images (on the border of the canvas) or the edges
+            aren't found yet.
+        '''
+        if self.edges is None:
+            return None
+        x = int(self.canvas.canvasx(event.x))
+        y = int(self.canvas.canvasy(event.y))
+        if not ( 0 <= x < self.w*2 and 0 <= y < self.h ):
+            return None
+        x %= self.w
+        if self.edges[y, x]:
+            return None
+        return (x, y)
+
+    def reselect(self):
+        '''
+            Finds the areas around the clicked points of the current image
+            at the current threshold. Points that are on an edge at this
+            threshold are kept, so their areas come back if the threshold
+            goes back up.
+            The color stats of an area are worked out when it is first
+            selected and kept for as long as it stays selected.
+            The clicked points are kept as points of the full size picture,
+            the areas and stats are those of the shown pyramid level.
+        '''
+        tree = self.tree
+        found = dict()
+        areas, stats = [], []
+        for seed in self.highlight_seeds.get(self.img_path, []):
+            x, y = pyramid.to_level( seed, self.level )
+            n = tree.node( x, y, self.edge_threshold )
+
+            # Two points may end up in the same area
+            if n is None or n in found:
+                continue
+
+            if n in self.selected:
+                found[n] = self.selected[n]
+            else:
+                area = tree.area( n )
+                found[n] = ( area, colorstats.measure( area, self.pixels ) )
+            areas.append( found[n][0] )
+            stats.append( found[n][1] )
+
+        self.selected = found
+        self.highlight_area[self.img_path] = areas
+        self.highlight_stats[self.img_path] = stats
+
+    @instrument.timed( "draw highlight" )
+    def drawHighlight(self, full=False):
+        '''
+            Colors in the selected areas of the current picture
+            with their average color.
+            Only the box around what was colored in before and what is
+            colored in now is drawn again, unless full is set.
+            Nothing is drawn while the edges are being found.
+        '''
+        if self.edges is None:
+            return
+
+        areas = self.highlight_area.get(self.img_path, [])
+
+        #Get the color
+        color = colorstats.total(self.highlight_stats.get(self.img_path, []))\
+                    .average()
+
+        box = None
+        for area in areas:
+            box = regions.box_union( box, area.box )
+        dirty = regions.box_union( self.painted_box, box )
+        if full:
+            dirty = (0, 0, self.w, self.h)
+        self.painted_box = box
+
+        if dirty is None:
+            return
+        
+        #Color in the area
+        self.highlight_img = edge.highlight_box(self.edges, areas, color, dirty)
+
+        if dirty == (0, 0, self.w, self.h):
+            self.edge_pic.paste(self.highlight_img)
+        else:
+            self.pasteAt(self.edge_pic, self.highlight_img, dirty[0], dirty[1])
+
+    @instrument.timed( "photo" )
+    def pasteAt(self, photo, img, left, top):
+        '''
+            Draws a PIL image into part of a PhotoImage. ImageTk's paste
+            always starts at the corner, so the image is made into a small
+            PhotoImage of its own and Tk copies that into place.
+        '''
+        part = ImageTk.PhotoImage(img)
+        photo.tk.call(str(photo), 'copy', str(part), '-to', left, top)
+
     def OnCanvasClick(self,event):
         '''
             Clears whatever previous area there was and gets this area.
         '''
     
-        self.edge_pixels = list( self.edge_img.getdata() )
+        if self.edges is None:
+            return # there is nothing to click on yet
 
         # Clear whatever area was already on this picture
-        self.highlight_area[self.img_path] = []
+        self.highlight_seeds[self.img_path] = []
         
         
         #Grab the area around the event
-        self.highlight_area[self.img_path].append(\
-                                edge.getarea(self.edge_pixels, self.w, self.h,\
-                                int(self.canvas.canvasx(event.x) % self.w),\
-                                int(self.canvas.canvasx(event.y) ) ) )
-        
-        #Get the color
-        color = edge.average_color(self.pixels,\
-                                   self.w, self.h,\
-                                   self.highlight_area[self.img_path])
-        
-        #Color in the area
-        self.highlight_img = edge.highlight(self.edge_pixels,\
-                                            self.w, self.h,\
-                                            self.highlight_area[\
-                                                self.img_path], color)
+        point = self.clickedPoint(event)
+        if point is not None:
+            self.highlight_seeds[self.img_path].append(\
+                pyramid.from_level(point, self.level))
         
-        self.highlight_pic = ImageTk.PhotoImage(self.highlight_img)
-
-        self.canvas.create_image( self.w, 0,\
-                                  image=self.highlight_pic,\
-                                  anchor = 'nw' )
+        self.updateSelection()
 
     def OnCanvasShiftClick(self,event):
         '''
             Adds any new area to whatever you already have.
             If you click on an already added area, nothing happens.
         '''
-        event.widget.find_closest(event.x, event.y)
+        point = self.clickedPoint(event)
+        if point is None:
+            return
+        x, y = point
         
-        #Checks if the area is already added. If so, it will be removed from the list
-        #n is the position in the list of an area of adjacent pixels
-        #i is the actual list of adjacent pixels
+        #Checks if the area is already added.
         #If the event is within i, then there's no need to add to area
-        for i in self.highlight_area[self.img_path]:
-                try:
-                    dummy = i.index( (self.canvas.canvasx(event.x)%self.w,\
-                                    self.canvas.canvasx(event.y)) )
-                    return
-                except(ValueError,AttributeError):
-                    continue
+        for i in self.highlight_area.get(self.img_path, []):
+            if (x, y) in i:
+                return
                 
-        self.edge_pixels = list( self.edge_img.getdata() )
-        self.highlight_area[self.img_path].append(\
-            edge.getarea( self.edge_pixels, self.w, self.h, \
-                          int(self.canvas.canvasx(event.x)%self.w),\
-                          int(self.canvas.canvasx(event.y)) ) )
+        self.highlight_seeds.setdefault(self.img_path, []).append(\
+            pyramid.from_level(point, self.level))
             
-        color = edge.average_color( self.pixels,\
-                                    self.w, self.h,\
-                                    self.highlight_area[self.img_path] )
-            
-        self.highlight_img = edge.highlight(self.edge_pixels,\
-                                            self.w, self.h,\
-                                            self.highlight_area[self.img_path], color)
-            
-        self.highlight_pic = ImageTk.PhotoImage(self.highlight_img)
-        self.canvas.create_image( self.w, 0,\
-                                  image = self.highlight_pic, anchor = 'nw')
+        self.updateSelection()
             
     def OnCanvasControlClick(self,event):
         '''
             Adds any new area to whatever you already have.
             If you click on an already added area, it will be removed.
         '''
-        event.widget.find_closest(event.x, event.y)
+        point = self.clickedPoint(event)
+        if point is None:
+            return
+        x, y = point
+        seeds = self.highlight_seeds.setdefault(self.img_path, [])
         
-        delete = -1
+        delete = None
                 
-        #Checks if the area is already added. If so, it will be removed from the list
-        #n is the position in the list of an area of adjacent pixels
-        #i is the actual list of adjacent pixels
-        #If the event is within i, index will succeed and delete will be the area number
-        #Otherwise, index will raise an error and delete won't change.
-        for n,i in enumerate(self.highlight_area[self.img_path]):
-                try:
-                    dummy = i.index( (self.canvas.canvasx(event.x)%self.w,\
-                                     self.canvas.canvasx(event.y)) )
-                    delete = n
-                except(ValueError,AttributeError):
-                    continue
+        #Checks if the area is already added. If so, it will be removed
+        #along with every point that was clicked inside it
+        for i in self.highlight_area.get(self.img_path, []):
+            if (x, y) in i:
+                delete = i
         
-        self.edge_pixels = list( self.edge_img.getdata() )
-        
-        if delete != -1:
-            self.highlight_area[self.img_path].pop(delete)
+        if delete is not None:
+            seeds[:] = [seed for seed in seeds\
+                        if pyramid.to_level(seed, self.level) not in delete]
             
         else:
+            seeds.append(pyramid.from_level(point, self.level))
             
-            self.highlight_area[self.img_path].append(\
-                edge.getarea( self.edge_pixels, self.w, self.h,\
-                              int(self.canvas.canvasx(event.x)%self.w),\
-                              int(self.canvas.canvasx(event.y)) ) )
-            
-        color = edge.average_color( self.pixels,\
-                                    self.w, self.h,\
-                                    self.highlight_area[self.img_path] )
-            
-        self.highlight_img = edge.highlight( self.edge_pixels,\
-                                             self.w, self.h,\
-                                             self.highlight_area[self.img_path], color )
-            
-        self.highlight_pic = ImageTk.PhotoImage(self.highlight_img)
-        self.canvas.create_image( self.w, 0,\
-                                  image = self.highlight_pic, anchor = 'nw' )
+        self.updateSelection()
+
+    def redrawEdges(self):
+        '''
+            Thresholds the stored gradient magnitude at the value of the
+            scale widget, finds the selected areas again at the new
+            threshold and redraws edge_pic.
+        '''
+        if self.magnitude is None:
+            # Still being found, or cancelled; at the new threshold either way
+            self.findEdges()
+            return
+        self.thresholdEdges()
+
+        # The edges changed all over, so all of edge_pic is drawn again
+        self.updateSelection( full=True )
+
+    def OnScaleMove(self, value):
+        '''
+            Shows the edges, and the areas around the clicked points,
+            for the new threshold while the slider is being dragged.
+        '''
+        if self.magnitude is None or int(value) == self.edge_threshold:
+            return
+        self.redrawEdges()
 
     def OnScaleRelease(self, event):
         '''
             Adjusts the threshold based on the value of the scale widget.
-            Redraws edge_img and edge_pic; deletes any highlighting
-            for the current picture.
+            Redraws edge_img and edge_pic; the selection of the current
+            picture follows the new threshold.
         '''
-        self.canvas.delete( self.edge_pic )
-        self.canvas.delete( self.highlight_pic )
-        
         # Redo the edge detection image with the new threshold
-        self.edge_img = edge.prewitt( self.pixels,\
-                                      self.w, self.h,\
-                                      self.scale.get() )
-        self.highlight_area[self.img_path] = []
-
-        # draw the new image
-        self.edge_pic = ImageTk.PhotoImage(self.edge_img)
-        self.canvas.create_image( self.w, 0, image=self.edge_pic, anchor='nw' )
+        self.redrawEdges()
 
         self.thresholds[self.img_path] = self.scale.get()
 
@@ -418,43 +769,59 @@ class EasierTrain(tk.Tk):
         '''
             Handles request for previous or next image.
             Assumes next image was requested unless otherwise indicated.
-            Preserves selection of the previous pictures.
         ''' 
         
         target = 1
         if goToNext==False:
             target = -1 
 
+        self.GoTo( self.img_index+target, target )
+
+    def GoTo(self, index, step=1):
+        '''
+            Shows the picture at index in imgpaths, without going through
+            the ones in between. A file that turns out not to be a picture
+            is dropped and the next one in the direction of step is shown.
+            Nothing is shown if no pictures are left.
+            Preserves selection of the previous pictures.
+        '''
+        if not self.imgpaths:
+            return
+
         # store the current threshold for later reference
         self.thresholds[self.img_path] = self.scale.get()
 
-        # increment to the next image
-        self.img_index = (self.img_index+target) % len(self.imgpaths)
-
-        self.img_path = self.imgpaths[self.img_index]
+        self.img_index = index % len(self.imgpaths)
+        while True:
+            self.img_path = self.imgpaths[self.img_index]
 
-        # restore the threshold of the new image
-        self.scale.set( self.thresholds[self.img_path] )
-        self.drawImg()
+            # restore the threshold of the new image
+            self.scale.set( self.thresholds.setdefault( self.img_path,\
+                                                        DEFAULT_THRESHOLD ) )
+            try:
+                self.drawImg()
+                break
+            except(IOError):
+                # It only looked like a picture, so it goes from the list.
+                # Going forward, the next one has just moved into its place.
+                print "Not a compatible image file", self.img_path
+                self.imgpaths.pop( self.img_index )
+                del self.thresholds[self.img_path]
+                if not self.imgpaths:
+                    print "No pictures left to show"
+                    return
+                if step < 0:
+                    self.img_index -= 1
+                self.img_index %= len(self.imgpaths)
         
-        if self.img_index not in self.highlight_area:
+        if self.img_path not in self.highlight_area:
             self.highlight_area[self.img_path] = []
+            self.highlight_stats[self.img_path] = []
+            self.highlight_seeds[self.img_path] = []
         
         else:
             # draw the previous highlighting of the new image, if any
-            color = edge.average_color(self.pixels,\
-                                   self.w, self.h,\
-                                   self.highlight_area[self.img_path])
-        
-            self.highlight_img = edge.highlight(
-                self.edge_pixels, self.w, self.h,\
-                self.highlight_area[self.img_path], color )
-        
-            self.highlight_pic = ImageTk.PhotoImage(self.highlight_img)
-
-            self.canvas.create_image( self.w, 0,\
-                                  image=self.highlight_pic,\
-                                  anchor = 'nw' )
+            self.drawHighlight()
 
     def OnNextClick(self):
         '''
@@ -469,49 +836,54 @@ class EasierTrain(tk.Tk):
         '''
         self.PrevNextHandler(False)
         
+    def OnThumbnailsClick(self):
+        '''
+            Opens the thumbnail browser, or brings it to the front.
+        '''
+        if self.browser is None:
+            self.browser = thumbnails.ThumbnailBrowser( self )
+        else:
+            self.browser.lift()
+
     def OnAddClick(self):
         '''
             Attempts to add the current selection to the color palette.
             Checks that <20 colors are in the palette and that the average
-            color is not (0,0,0) i.e. no selection.
+            color is not (0,0,0) i.e. no selection. The selection is found
+            at full size in the background, see selectionWork(), and the
+            color is added by addDone().
         '''
         if len( self.colorNameInputs ) == 20:
             print "ERROR: Tekkotsu is currently limited to 20 colors."
             print "       Delete some colors first."
             return
-        
-        R, G, B = (-1,-1,-1)
-        total_area = 0
-        
-        for highlighted_img_path in self.highlight_area.keys():
-            add_img = Image.open( highlighted_img_path )
-            add_pixels = list( add_img.getdata() )
-            add_w, add_h = add_img.size
-            
-            this_area = 0
-            for area in self.highlight_area[highlighted_img_path]:
-                this_area += len(area)
-                
-                    
-            color = edge.average_color( add_pixels,\
-                                    add_w, add_h,\
-                                    self.highlight_area[highlighted_img_path] )
-            
-            try:
-                
-                R = (total_area * R + this_area * color[0])/(total_area+this_area)
-                G = (total_area * G + this_area * color[1])/(total_area+this_area)
-                B = (total_area * B + this_area * color[2])/(total_area+this_area)
-                
-                total_area += this_area
-            
-            except(TypeError):
-                continue
-               
-            
-        color = (R,G,B)
-        
-        if color == (-1,-1,-1):
+        if self.paletteTask is not None and not self.paletteTask.cancelled:
+            return
+
+        jobs = self.selectionJobs()
+        if jobs:
+            self.paletteTask = self.tasks.start( "Adding color",\
+                                                 self.selectionWork,\
+                                                 self.addDone, jobs )
+
+    def addDone(self, result):
+        '''
+            Adds the selection found by selectionWork() to the palette
+            as a new color.
+        '''
+        self.paletteTask = None
+
+        added = dict() # one area per picture for the color
+        stats = []
+        for path, area, selected in result:
+            added[path] = area
+            stats.append( selected )
+
+        total = colorstats.total( stats )
+        color = total.average()
+        hist = total.hist
+
+        if color is None:
             return
 
         hexcol = self.rgbTupleToHex(color)
@@ -526,11 +898,70 @@ class EasierTrain(tk.Tk):
             else:
                 i+=1
                 
-        self.master_color_list.append( [self.highlight_area , color, "New color"+str(colorNum)] )
+        self.master_color_list.append( [added , color, "New color"+str(colorNum), hist] )
         self.highlight_area = dict()
+        self.highlight_seeds = dict()
+        self.highlight_stats = dict()
 
         self.AppendToPalette( "New color "+str(colorNum), hexcol )
 
+    def selectionJobs(self):
+        '''
+            Returns what selectionWork() needs: for every picture with
+            something selected, its path, areas and their colorstats,
+            the clicked points and its edge threshold.
+        '''
+        jobs = []
+        for path, areas in self.highlight_area.items():
+            if not len( areas ):
+                continue
+            threshold = self.thresholds.get( path, DEFAULT_THRESHOLD )
+            if path == self.img_path:
+                threshold = self.edge_threshold
+            jobs.append( ( path, list( areas ),\
+                           list( self.highlight_stats[path] ),\
+                           list( self.highlight_seeds.get( path, [] ) ),\
+                           threshold ) )
+        return jobs
+
+    def selectionWork(self, progress, jobs):
+        '''
+            Returns (path, area, colorstats) of the selection in each
+            picture of the jobs made by selectionJobs(), at full size.
+            Runs on a worker thread, so it must not touch any widgets.
+        '''
+        found = []
+        for i, job in enumerate( jobs ):
+            progress( float( i ) / len( jobs ) )
+            area, selected = self.selection( *job )
+            if area is not None:
+                found.append( ( job[0], area, selected ) )
+        return found
+
+    def selection(self, path, areas, stats, seeds, threshold):
+        '''
+            Returns the area selected in a picture, at full size, and its
+            colorstats, or (None, None) if nothing is selected at full size.
+            Pictures that were previewed at a smaller pyramid level have
+            their areas found again at full size from the clicked points,
+            the same areas clicking on the full size picture would give.
+        '''
+        if pyramid.picture_level( path ) == 0:
+            return regions.union_all( areas ), colorstats.total( stats )
+
+        with instrument.span( "full size selection" ):
+            edges = edge.edges( fieldcache.gradient( path ), threshold )
+            labels = edge.label( edges )
+            found = dict()
+            for (x, y) in seeds:
+                if labels[y, x] and labels[y, x] not in found:
+                    found[labels[y, x]] = edge.getarea( labels, x, y )
+            if not found:
+                return None, None
+            area = regions.union_all( found.values() )
+            return area, colorstats.measure( area,\
+                                             pixelbuffer.from_file( path ) )
+
     def AppendToPalette(self, name, hexcol, draw=True):
         '''
             Takes a name and hex color and appends it to the color palette.
@@ -546,14 +977,13 @@ class EasierTrain(tk.Tk):
         newEntry = tk.Entry( self.palette, width=10 )
         newEntry.insert( 0, name )
 
-        # make a new color frame
-        # TODO make the mouse curor change on mouse-over to reflect
-        # clickable status
+        # make a new color frame, clicking it adds the selection to the color
         newFrame = tk.Frame( self.palette,\
                              height=25, width=40,\
                              relief='raised',\
                              borderwidth=5,\
-                             background=hexcol )
+                             background=hexcol,\
+                             cursor='hand2' )
         newFrame.bind( "<Button-1>", self.OnColorClick )
 
         self.colorChkbtn.append(newChkbtn)
@@ -564,29 +994,75 @@ class EasierTrain(tk.Tk):
             self.drawPalette()
 
     def OnSaveClick(self):
-        
+        '''
+            Makes the .tm/.col files and saves the session in the background.
+            A save that is still going on is given up for this one.
+        '''
+        if self.saveTask is not None:
+            self.saveTask.cancel()
+        self.saveTask = self.tasks.start( "Saving", self.saveWork,\
+                                          self.saveDone, *self.saveState() )
+
+    def saveState(self):
+        '''
+            Returns what saveWork() needs: the palette colors, copies of
+            them and of the thresholds to be saved, and the pictures.
+            The copies let the palette be changed while they are saved.
+        '''
         # Update the names of the colors from the Entry widgets
         for i in xrange( 0, len( self.master_color_list ) ):
             self.master_color_list[i][2] = self.colorNameInputs[i].get()
-        
-        generator.generate_color_space(self.master_color_list, self.imgpaths)
 
-        toSerialize = [self.master_color_list,
-                       self.thresholds]
+        colors = []
+        for color_data in self.master_color_list:
+            copy = [ dict( color_data[0] ), color_data[1], color_data[2] ]
+            if len( color_data ) > 3:
+                copy.append( color_data[3].copy() )
+            colors.append( copy )
+        return list( self.master_color_list ), colors,\
+               dict( self.thresholds ), list( self.imgpaths )
 
+    def saveWork(self, progress, originals, colors, thresholds, imgpaths):
+        '''
+            Makes the .tm/.col files and saves the session, from the copies
+            made by saveState(). Runs on a worker thread, so it must not
+            touch any widgets.
+        '''
+        self.saving.acquire()
         try:
-            pickle.dump(toSerialize, open("default.et", "w"))
-
-        except(pickle.PicklingError):
-            print "Failed to write default.et"
+            generator.generate_color_space( colors, imgpaths,\
+                                            progress=progress )
+            session.save( "default.et", colors, thresholds )
+        finally:
+            self.saving.release()
+        return originals, colors
+
+    def saveDone(self, result):
+        '''
+            Keeps the histograms made while saving, for the colors whose
+            areas haven't changed since, so they aren't made again.
+        '''
+        self.saveTask = None
+        for original, copy in zip( *result ):
+            if len( original ) < 4 and len( copy ) > 3\
+               and original[0] == copy[0]:
+                original.append( copy[3] )
 
     def OnLoadClick(self):
-        deserialized = pickle.load(open("default.et", "r"))
+        '''
+            Replaces the palette with the one of the saved session.
+            The swatches of the old palette are taken away, so the i-th
+            swatch stays the i-th color of the master color list.
+        '''
+        self.master_color_list, self.thresholds = session.load("default.et")
 
-        self.master_color_list = deserialized[0]
-        self.thresholds = deserialized[1]
+        for widgets in ( self.colorChkbtn, self.colorNameInputs,\
+                         self.colorFrames ):
+            for obj in widgets:
+                obj.grid_remove()
+            del widgets[:]
 
-        for color_data in deserialized[0]:
+        for color_data in self.master_color_list:
             self.highlighted_area = color_data[0]
             hexcol = self.rgbTupleToHex(color_data[1])
             self.AppendToPalette(color_data[2], hexcol, False)
@@ -638,7 +1114,8 @@ class EasierTrain(tk.Tk):
         self.savequit.grid( column=2, row=0, padx=2, pady=3 )
         
     def OnSaveQuitClick(self):
-        self.OnSaveClick()
+        # There is no waiting for the background on the way out
+        self.saveWork( None, *self.saveState() )
         sys.exit(0)
         
     def OnExitQuitClick(self):
@@ -648,12 +1125,105 @@ class EasierTrain(tk.Tk):
         self.quit.destroy()
 
     def OnColorClick(self, event):
-        print "TODO"
-        pass
+        '''
+            Adds the current selection to the color that was clicked on
+            in the palette. Only pixels the color didn't already have are
+            counted into its histogram and average color. The work is done
+            in the background by colorWork(), and colorDone() changes the
+            color.
+        '''
+        if event.widget not in self.colorFrames:
+            return
+        if self.paletteTask is not None and not self.paletteTask.cancelled:
+            return
+        i = self.colorFrames.index( event.widget )
+        color_data = self.master_color_list[i]
 
-    def OnColorClick(self, event):
-        print "TODO"
-        pass
+        jobs = self.selectionJobs()
+        if not jobs:
+            return
+        hist = None
+        if len(color_data) > 3:
+            hist = color_data[3]
+        self.paletteTask = self.tasks.start( "Adding to color",\
+                                             self.colorWork,\
+                                             self.colorDone, color_data,\
+                                             dict( color_data[0] ), hist,\
+                                             jobs )
+
+    def colorWork(self, progress, color_data, areas, hist, jobs):
+        '''
+            Finds the selection at full size and the colorstats of the
+            pixels of it that aren't in the areas of the color yet, and
+            the histogram of the color if it has none.
+            Runs on a worker thread, so it must not touch any widgets.
+        '''
+        if hist is None:
+            hist = generator.area_histogram( areas )
+
+        added = []
+        for path, area, selected in self.selectionWork( progress, jobs ):
+            if path in areas:
+                new_area = area.difference( areas[path] )
+            else:
+                new_area = area
+
+            # Only if some of the selection was in the color already
+            # do the new pixels have to be looked at again
+            if not len(new_area):
+                stats = None
+            elif len(new_area) == len(area):
+                stats = selected
+            else:
+                stats = colorstats.measure( new_area,\
+                                            pixelbuffer.from_file( path ) )
+            added.append( ( path, area, stats ) )
+        return color_data, hist, added
+
+    def colorDone(self, result):
+        '''
+            Adds the selection found by colorWork() to its color.
+        '''
+        self.paletteTask = None
+        color_data, hist, added = result
+        for i in xrange( len( self.master_color_list ) ):
+            if self.master_color_list[i] is color_data:
+                break
+        else:
+            return # the palette was loaded again in the meantime
+        if len(color_data) < 4:
+            color_data.append( hist )
+
+        old_area = 0
+        for area in color_data[0].values():
+            old_area += len(area)
+        total_area = old_area
+        R, G, B = [c * old_area for c in color_data[1]]
+
+        for path, area, stats in added:
+            if path in color_data[0]:
+                color_data[0][path] = color_data[0][path].union( area )
+            else:
+                color_data[0][path] = area
+
+            if stats is None:
+                continue
+            R += stats.rgb[0]
+            G += stats.rgb[1]
+            B += stats.rgb[2]
+            total_area += stats.count
+
+            color_data[3] += stats.hist
+
+        self.highlight_area = dict()
+        self.highlight_seeds = dict()
+        self.highlight_stats = dict()
+
+        if total_area == old_area:
+            return
+
+        color_data[1] = (R/total_area, G/total_area, B/total_area)
+        self.colorFrames[i].config( background=self.rgbTupleToHex(color_data[1]) )
 
 if __name__ == "__main__":
     app = None
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+'''
+    Times the slow parts of EasierTrain on made up pictures.
+
+    $ python benchmark.py [options]
+
+    Runs the whole suite: edge detection, finding, highlighting and
+    averaging areas, the component tree, generate_color_space and saving
+    and loading sessions, on pictures from 160x120 up to 1280x960 with
+    few and with many edges. Each result is the best of a few runs, in
+    seconds. The results are written as JSON, and compared against an
+    earlier run with --compare, which lists everything that got slower
+    by more than the tolerance and exits with 1 if anything did.
+
+    $ python benchmark.py --scaling [options]
+
+    Times generate_color_space with different numbers of worker
+    processes instead. A set of random pictures and colors is made in a
+    temporary directory, then the .tm and .col files are generated once
+    per worker count. Every run has to give exactly the same files as the
+    single process one.
+
+    Nothing here needs a display.
+'''
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import optparse
+import multiprocessing
+import numpy
+import Image # PIL
+import edge
+import regions
+import session
+import generator
+import imagestore
+import components
+
+# Picture sizes, edge densities and palette sizes the suite goes through
+SIZES = "160x120,320x240,640x480,1280x960"
+DENSITIES = "0.1,0.9"
+COLORS = (1, 8, 20)
+
+# Pictures each color is picked from when generating
+PICTURES = 4
+
+# Threshold the edges are found at, the app's default
+THRESHOLD = 250
+
+def make_picture(width, height, block, rand):
+    '''
+        Returns a random picture as a height x width x 3 array. It is
+        made of block x block squares of noisy color, so the histograms
+        aren't all in one bin and there is an edge between every square.
+    '''
+    blocks = rand.randint(0, 256, (height // block + 1, width // block + 1, 3))
+    pixels = blocks.repeat(block, axis=0).repeat(block, axis=1)
+    pixels = pixels[:height, :width] + rand.randint(-8, 8, (height, width, 3))
+    return pixels.clip(0, 255).astype(numpy.uint8)
+
+def block_size(density):
+    '''
+        Returns the side of the squares of make_picture() for an edge
+        density between 0 (64 pixel squares) and 1 (4 pixel squares).
+    '''
+    return int(round(64 / (1 + 15 * density)))
+
+def make_pictures(imgdir, count, width, height, rand, block=16):
+    '''
+        Writes count random pictures into imgdir and returns their paths.
+    '''
+    paths = []
+    for i in xrange(count):
+        pixels = make_picture(width, height, block, rand)
+        path = os.path.join(imgdir, "bench%dx%d_%03d.png" % (width, height, i))
+        Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+def make_colors(paths, count, width, height, rand):
+    '''
+        Makes count colors, each with a few random rectangles
+        in half of the pictures.
+    '''
+    colors = []
+    for c in xrange(count):
+        areas = dict()
+        for path in paths:
+            if rand.randint(2):
+                continue
+            mask = numpy.zeros((height, width), bool)
+            for r in xrange(3):
+                x, y = rand.randint(width), rand.randint(height)
+                mask[y:y + rand.randint(10, height // 2),
+                     x:x + rand.randint(10, width // 2)] = True
+            areas[path] = regions.from_mask(mask)
+        colors.append([areas, (128, 128, 128), "bench" + str(c)])
+    return colors
+
+def run(colors, imgdir, outdir, workers):
+    '''
+        Generates the files once and returns (seconds, tm data, col data).
+    '''
+    tmpath = os.path.join(outdir, "bench.tm")
+    colpath = os.path.join(outdir, "bench.col")
+
+    # Leave out any histograms from earlier runs
+    colors = [color[:3] for color in colors]
+
+    start = time.time()
+    generator.generate_color_space(colors, imgdir, tmpath, colpath,
+                                   workers=workers)
+    seconds = time.time() - start
+
+    return seconds, open(tmpath, "rb").read(), open(colpath, "rb").read()
+
+def best(func, repeat):
+    '''
+        Calls func repeat times and returns the fastest, in seconds.
+    '''
+    fastest = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        if fastest is None or seconds < fastest:
+            fastest = seconds
+    return fastest
+
+def smallest_area(labels):
+    '''
+        Returns a point inside the smallest area of labels.
+    '''
+    counts = numpy.bincount(labels.ravel())
+    counts[0] = counts.max() + 1 # the edges
+    ys, xs = numpy.nonzero(labels == counts.argmin())
+    return int(xs[0]), int(ys[0])
+
+def suite(sizes, densities, repeat, report):
+    '''
+        Runs every benchmark and returns { name : seconds }.
+        Report is called with each name and result as they come.
+    '''
+    results = dict()
+    def timed(name, func):
+        results[name] = best(func, repeat)
+        report(name, results[name])
+
+    rand = numpy.random.RandomState(0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for width, height in sizes:
+            size = "%dx%d" % (width, height)
+            for density in densities:
+                tag = "%s d%.1f" % (size, density)
+                pixels = make_picture(width, height, block_size(density),
+                                      rand)
+
+                timed("prewitt " + tag,
+                      lambda: edge.prewitt(pixels, THRESHOLD))
+                magnitude = edge.gradient(pixels)
+                edges = edge.edges(magnitude, THRESHOLD)
+                timed("label " + tag, lambda: edge.label(edges))
+                labels = edge.label(edges)
+
+                # The smallest area there is, and one that is the
+                # whole picture but for the border
+                x, y = smallest_area(labels)
+                timed("getarea small " + tag,
+                      lambda: edge.getarea(labels, x, y))
+                small = edge.getarea(labels, x, y)
+                bare = edge.label(edge.edges(magnitude,
+                                             edge.BORDER_MAGNITUDE - 1))
+                timed("getarea huge " + tag,
+                      lambda: edge.getarea(bare, 1, 1))
+                huge = edge.getarea(bare, 1, 1)
+
+                timed("highlight " + tag,
+                      lambda: edge.highlight(edges, [small, huge],
+                                             (255, 0, 0)))
+                timed("average_color " + tag,
+                      lambda: edge.average_color(pixels, [huge]))
+
+                timed("component_tree " + tag,
+                      lambda: components.ComponentTree(magnitude))
+                tree = components.ComponentTree(magnitude)
+                timed("tree area " + tag,
+                      lambda: tree.area(tree.node(x, y, THRESHOLD)))
+
+            # Generating goes through every selected pixel of every picture
+            paths = make_pictures(tmpdir, PICTURES, width, height, rand)
+            tmpath = os.path.join(tmpdir, "bench.tm")
+            colpath = os.path.join(tmpdir, "bench.col")
+            etpath = os.path.join(tmpdir, "bench.et")
+            made = []
+            for count in COLORS:
+                colors = make_colors(paths, count, width, height, rand)
+                def generate():
+                    # Without histograms or decoded pictures every time
+                    imagestore.store.clear()
+                    made[:] = [color[:3] for color in colors]
+                    generator.generate_color_space(made, tmpdir, tmpath,
+                                                   colpath)
+                timed("generate_color_space %s c%d" % (size, count), generate)
+
+            # The last colors made have their histograms, which are saved
+            colors = made
+            timed("session save %s c%d" % (size, count),
+                  lambda: session.save(etpath, colors, dict()))
+            timed("session load %s c%d" % (size, count),
+                  lambda: session.load(etpath))
+            def load_all():
+                for color in session.load(etpath)[0]:
+                    for area in color[0].values():
+                        area.mask()
+            timed("session load all %s c%d" % (size, count), load_all)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+        Prints how results compare to the baseline results and returns
+        the names of the benchmarks that are slower by more than tolerance,
+        a fraction. Differences under a millisecond are put down to noise.
+    '''
+    slower = []
+    print "%-40s %9s %9s %7s" % ("benchmark", "baseline", "now", "ratio")
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-40s %9s %9.4f" % (name, "-", results[name])
+            continue
+        old, new = baseline[name], results[name]
+        ratio = new / max(old, 1e-9)
+        flag = ""
+        if ratio > 1 + tolerance and new - old > 0.001:
+            flag = "  SLOWER"
+            slower.append(name)
+        print "%-40s %9.4f %9.4f %7.2f%s" % (name, old, new, ratio, flag)
+    for name in sorted(baseline):
+        if name not in results:
+            print "%-40s %9.4f %9s" % (name, baseline[name], "-")
+    return slower
+
+def scaling(options):
+    '''
+        Times generate_color_space with 1, 2, 4... up to options.workers
+        worker processes and prints a table of the times.
+    '''
+    width, height = [int(n) for n in options.size.split("x")]
+    rand = numpy.random.RandomState(0)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = make_pictures(tmpdir, options.pictures, width, height, rand)
+        colors = make_colors(paths, options.colors, width, height, rand)
+
+        counts = [1]
+        while counts[-1] * 2 <= options.workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != options.workers:
+            counts.append(options.workers)
+
+        print "%d pictures of %dx%d, %d colors" % (options.pictures,
+                                                   width, height,
+                                                   options.colors)
+        print "workers   seconds   speedup"
+        first = None
+        for workers in counts:
+            seconds, tm, col = run(colors, tmpdir, tmpdir, workers)
+            if first is None:
+                first = (seconds, tm, col)
+            elif (tm, col) != first[1:]:
+                print "output with %d workers differs!" % workers
+                return 1
+            print "%7d   %7.2f   %7.2f" % (workers, seconds,
+                                          first[0] / seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", default="benchmark.json",
+                      help="where the results go [default: %default]")
+    parser.add_option("--compare", metavar="BASELINE",
+                      help="compare the results with an earlier output")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="how much slower counts as a regression "
+                           "[default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each benchmark, the fastest counts "
+                           "[default: %default]")
+    parser.add_option("--sizes", default=SIZES,
+                      help="picture sizes [default: %default]")
+    parser.add_option("--densities", default=DENSITIES,
+                      help="edge densities, 0 to 1 [default: %default]")
+    parser.add_option("--scaling", action="store_true", default=False,
+                      help="time worker processes instead of the suite")
+    parser.add_option("-p", "--pictures", type="int", default=24,
+                      help="pictures to make for --scaling "
+                           "[default: %default]")
+    parser.add_option("-c", "--colors", type="int", default=20,
+                      help="colors to make for --scaling [default: %default]")
+    parser.add_option("-s", "--size", default="640x480",
+                      help="picture size for --scaling [default: %default]")
+    parser.add_option("-j", "--workers", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="most workers to try with --scaling "
+                           "[default: %default]")
+    options, args = parser.parse_args(argv)
+
+    if options.scaling:
+        return scaling(options)
+
+    sizes = [tuple([int(n) for n in size.split("x")])
+             for size in options.sizes.split(",")]
+    densities = [float(density) for density in options.densities.split(",")]
+
+    def report(name, seconds):
+        print "%-40s %9.4f" % (name, seconds)
+        sys.stdout.flush()
+    results = suite(sizes, densities, options.repeat, report)
+
+    out = open(options.output, "w")
+    json.dump({"python": platform.python_version(),
+               "numpy": numpy.__version__,
+               "machine": platform.platform(),
+               "results": results}, out, indent=1, sort_keys=True)
+    out.close()
+    print "Results written to", options.output
+
+    if options.compare:
+        baseline = json.load(open(options.compare))["results"]
+        slower = compare(results, baseline, options.tolerance)
+        if slower:
+            print len(slower), "benchmarks got slower"
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
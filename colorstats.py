@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+    Running color statistics of selected areas.
+
+    The pixels of an area are gone through once, when it is selected, for
+    how many there are, the sums of their R, G and B and of their Y, U and V,
+    and their histogram in the generator's color space. The stats of areas
+    that don't overlap just add up, so the average color and the histogram
+    of a whole selection come from the stats of its areas without looking
+    at a single pixel again.
+'''
+
+import numpy
+import generator
+import pixelbuffer
+
+class ColorStats:
+    '''
+        Stats of a set of pixels. Rgb and yuv are the sums of each channel,
+        hist is their generator.color_histogram(), or None if not kept.
+    '''
+    def __init__(self, count=0, rgb=(0, 0, 0), yuv=(0, 0, 0), hist=None):
+        self.count = count
+        self.rgb = tuple(rgb)
+        self.yuv = tuple(yuv)
+        self.hist = hist
+
+    def __add__(self, other):
+        '''
+            Returns the stats of the pixels of both, which must not overlap.
+            The histogram is only kept if both have one.
+        '''
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+
+        hist = None
+        if self.hist is not None and other.hist is not None:
+            hist = self.hist + other.hist
+        return ColorStats(self.count + other.count,
+                          [a + b for a, b in zip(self.rgb, other.rgb)],
+                          [a + b for a, b in zip(self.yuv, other.yuv)],
+                          hist)
+
+    def average(self):
+        '''
+            Returns the average (r,g,b) as integers, like
+            edge.average_color(), or None if there are no pixels.
+        '''
+        if not self.count:
+            return None
+        return tuple([total / self.count for total in self.rgb])
+
+    def averageYUV(self):
+        '''
+            Returns the average (y,u,v) as integers,
+            or None if there are no pixels.
+        '''
+        if not self.count:
+            return None
+        return tuple([total / self.count for total in self.yuv])
+
+def channel_sums(selected):
+    '''
+        Sums an n x 3 array of pixels channel by channel into Python ints.
+    '''
+    sums = selected.sum(axis=0, dtype=numpy.int64)
+    return [int(total) for total in sums]
+
+def measure(area, pixels, histogram=True):
+    '''
+        Goes through the pixels of a regions.Area once for its stats.
+        Pixels is the pixelbuffer.PixelBuffer of the picture.
+        The histogram is left out if histogram is False.
+    '''
+    yuv = area.pixels(pixels.ycbcr())
+    hist = None
+    if histogram:
+        hist = generator.pixel_histogram(yuv)
+    return ColorStats(len(area), channel_sums(area.pixels(pixels.rgb())),
+                      channel_sums(yuv), hist)
+
+def total(stats):
+    '''
+        Adds up a list of stats of areas that don't overlap.
+    '''
+    combined = ColorStats()
+    for other in stats:
+        combined = combined + other
+    return combined
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+    Threshold component tree for the edge magnitudes of a picture.
+
+    Raising the threshold only ever takes edges away, so the areas between
+    the edges only ever grow and join together. Instead of thresholding and
+    labeling the picture again for every value of the slider, the pixels are
+    sorted by gradient magnitude once and joined Kruskal-style from the
+    smallest magnitude up. Every time areas join, or an area grows, a node is
+    added to a merge tree along with the magnitude it happened at. The areas
+    at any threshold, and the area under any point, are then read straight
+    from the tree.
+'''
+
+import numpy
+import edge
+import regions
+import instrument
+
+# The arrays that make up a tree, see ComponentTree
+ARRAYS = ('parent', 'level', 'pixnode', 'size', 'start', 'pixels')
+
+def find(root, items):
+    '''
+        Finds the union-find roots of an array of items,
+        pointing the items straight at them on the way out.
+    '''
+    found = root[items]
+    while True:
+        up = root[found]
+        if (up == found).all():
+            break
+        found = up
+    root[items] = found
+    return found
+
+class ComponentTree:
+    '''
+        Built once per picture from the magnitude array of edge.gradient().
+        Pixels are flat indices, x + y * width, like everywhere else.
+
+        The tree is kept in flat arrays:
+            parent[n]   parent node of node n, or -1 for the root
+            level[n]    magnitude at which the area of node n came to be;
+                        the area is there for every threshold above it
+            pixnode[p]  the node pixel p first joins, at magnitude[p]
+            pixels      every pixel, ordered so that the area of node n is
+                        pixels[start[n]:start[n]+size[n]]
+        A parent is always made after its children, so parent[n] > n.
+
+        A tree that was built before can be put back together from its
+        arrays() instead, given as saved.
+        Progress, if given, is called now and then with the fraction of the
+        magnitude levels that are done.
+    '''
+    def __init__(self, magnitude, saved=None, progress=None):
+        self.height, self.width = magnitude.shape
+        self.magnitude = magnitude.ravel()
+        count = self.height * self.width
+
+        if saved is not None:
+            for name in ARRAYS:
+                setattr(self, name, saved[name])
+            return
+
+        # A pair of touching pixels is joined once the threshold is above
+        # both of them, so the pixels and the pairs are sorted by that level
+        first, second = edge.neighbours(self.height, self.width)
+        weight = numpy.maximum(self.magnitude[first], self.magnitude[second])
+
+        byPixel = numpy.argsort(self.magnitude)
+        byPair = numpy.argsort(weight)
+        first, second, weight = first[byPair], second[byPair], weight[byPair]
+
+        levels = numpy.unique(self.magnitude)
+        pixelBounds = numpy.append(\
+            numpy.searchsorted(self.magnitude[byPixel], levels), count)
+        pairBounds = numpy.append(\
+            numpy.searchsorted(weight, levels), len(weight))
+
+        root = numpy.arange(count) # union-find over the pixels
+        rootNode = -numpy.ones(count, int) # tree node of each root
+
+        # Every node has at least one pixel joining at its level,
+        # so there can't be more nodes than pixels
+        parent = -numpy.ones(count, int)
+        level = numpy.zeros(count, self.magnitude.dtype)
+        pixnode = numpy.empty(count, int)
+        nodes = 0
+
+        for i in xrange(len(levels)):
+            if progress is not None and i % 64 == 0:
+                progress(float(i) / len(levels))
+            new = byPixel[pixelBounds[i]:pixelBounds[i+1]]
+            a = find(root, first[pairBounds[i]:pairBounds[i+1]])
+            b = find(root, second[pairBounds[i]:pairBounds[i+1]])
+
+            # Group the roots touched at this level into the areas they join
+            touched, which = numpy.unique(numpy.concatenate((new, a, b)),\
+                                          return_inverse=True)
+            n, m = len(new), len(a)
+            groups = edge.join(len(touched), which[n:n+m], which[n+m:])
+            groups = numpy.unique(groups, return_inverse=True)[1]
+            made = groups.max() + 1
+
+            # One new node per area, above the nodes of the areas it joins
+            oldNode = rootNode[touched]
+            joined = oldNode >= 0
+            parent[oldNode[joined]] = nodes + groups[joined]
+            pixnode[new] = nodes + groups[which[:n]]
+            level[nodes:nodes+made] = levels[i]
+
+            head = numpy.empty(made, int)
+            head[groups] = touched
+            root[touched] = head[groups]
+            rootNode[head] = numpy.arange(nodes, nodes+made)
+            nodes += made
+
+        self.parent = parent[:nodes]
+        self.level = level[:nodes]
+        self.pixnode = pixnode
+
+        # Lay the pixels out so every area is one run: a node's own pixels
+        # come first, followed by the runs of its children
+        own = numpy.bincount(pixnode, minlength=nodes)
+        parentList = self.parent.tolist()
+        size = own.tolist()
+        for n in xrange(nodes):
+            if parentList[n] >= 0:
+                size[parentList[n]] += size[n]
+
+        start = [0] * nodes
+        nextFree = [0] * nodes
+        offset = 0
+        for n in reversed(xrange(nodes)):
+            p = parentList[n]
+            if p < 0:
+                start[n] = offset
+                offset += size[n]
+            else:
+                start[n] = nextFree[p]
+                nextFree[p] += size[n]
+            nextFree[n] = start[n] + own[n]
+
+        self.size = numpy.array(size)
+        self.start = numpy.array(start)
+        self.pixels = numpy.argsort(self.start[pixnode], kind='mergesort')
+
+    def arrays(self):
+        '''
+            Returns the arrays of the tree as a { name : array } dictionary,
+            everything needed to make it again along with the magnitude.
+        '''
+        return dict([(name, getattr(self, name)) for name in ARRAYS])
+
+    def node(self, xco, yco, threshold):
+        '''
+            Returns the node of the area holding (xco,yco) at the threshold,
+            or None if the point is on an edge.
+        '''
+        p = xco + yco * self.width
+        if self.magnitude[p] >= threshold:
+            return None
+
+        n = self.pixnode[p]
+        while self.parent[n] >= 0 and self.level[self.parent[n]] < threshold:
+            n = self.parent[n]
+        return n
+
+    @instrument.timed("tree area")
+    def area(self, n):
+        '''
+            Returns the area of a node as a regions.Area.
+        '''
+        return regions.from_pixels(\
+            self.pixels[self.start[n]:self.start[n]+self.size[n]],\
+            self.width, self.height)
+
+    def region(self, xco, yco, threshold):
+        '''
+            Returns the area enclosed by the edges around (xco,yco) at the
+            threshold, the same as edge.getarea() would,
+            or None if the point is on an edge.
+        '''
+        n = self.node(xco, yco, threshold)
+        if n is None:
+            return None
+        return self.area(n)
+
+    def history(self, xco, yco):
+        '''
+            Follows the area around (xco,yco) across every threshold.
+            Returns a list of (level, size, node) from the smallest area up:
+            for thresholds above level, and up to the next level in the list,
+            the point is in an area of that many pixels.
+        '''
+        n = self.pixnode[xco + yco * self.width]
+        found = []
+        while n >= 0:
+            found.append((int(self.level[n]), int(self.size[n]), n))
+            n = self.parent[n]
+        return found
+
+    def labels(self, threshold):
+        '''
+            Returns the labels of the areas at the threshold, the same as
+            edge.label(edge.edges(magnitude, threshold)) but without
+            touching the picture again.
+        '''
+        nodes = numpy.arange(len(self.parent))
+        above = numpy.where(self.parent >= 0, self.parent, nodes)
+        up = numpy.where(self.level[above] < threshold, above, nodes)
+        while True:
+            further = up[up]
+            if (further == up).all():
+                break
+            up = further
+
+        free = self.magnitude < threshold
+        labels = numpy.zeros(self.height * self.width, numpy.int32)
+        found, firstAt, which = numpy.unique(up[self.pixnode[free]],\
+                                             return_index=True,\
+                                             return_inverse=True)
+
+        # number the areas in the order they first show up, like edge.label
+        rank = numpy.empty(len(found), numpy.int32)
+        rank[numpy.argsort(firstAt)] = numpy.arange(1, len(found)+1)
+        labels[free] = rank[which]
+        return labels.reshape(self.height, self.width)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 '''
-    Uses hashes of tuples to simulate 2-d arrays for the masks.   
+    Uses NumPy arrays for the image pixels and the edge masks.
 
     Prewitt algorithms adapted for color edge detection by Nathan Heithoff
     for Introduction to Cognitive Robotics @ Rensselaer Polytechnic Institute
@@ -10,140 +10,315 @@
 '''
 
 import Image
+import numpy
+import regions
+import pixelbuffer
+import instrument
 import sys
 
-def get_prewitt_masks():
-    xmask = {}
-    ymask = {}
-  
-    xmask[(0,0)] = -1
-    xmask[(0,1)] = 0
-    xmask[(0,2)] = 1
-    xmask[(1,0)] = -1
-    xmask[(1,1)] = 0
-    xmask[(1,2)] = 1
-    xmask[(2,0)] = -1
-    xmask[(2,1)] = 0
-    xmask[(2,2)] = 1
-  
-    ymask[(0,0)] = 1
-    ymask[(0,1)] = 1
-    ymask[(0,2)] = 1
-    ymask[(1,0)] = 0
-    ymask[(1,1)] = 0
-    ymask[(1,2)] = 0
-    ymask[(2,0)] = -1
-    ymask[(2,1)] = -1
-    ymask[(2,2)] = -1
-    return (xmask, ymask)
-  
-   
-  
-def prewitt(pixels, width, height, threshold):
+# Edge strength given to the border of the image so that areas never
+# run off the side of the picture.
+BORDER_MAGNITUDE = 10000 #magic number
+
+# Rows worked on at once by gradient() and label(). The memory they need
+# on top of their output depends on this and the width, not the height.
+STRIP = 256
+
+@instrument.timed("prewitt")
+def gradient(pixels, strip=STRIP):
+    '''
+        Computes the Prewitt gradient magnitude of every pixel.
+        Pixels are the original image pixels as a pixelbuffer.PixelBuffer
+        or a height x width x 3 RGB array.
+
+        Returns a height x width integer array. The border is always given
+        BORDER_MAGNITUDE so it shows up as an edge.
+
+        The picture is gone through strip rows at a time, each with the row
+        above and below it, so big pictures don't need several times their
+        size in working arrays. The result is the same for any strip.
+    '''
+    pixels = pixelbuffer.rgb(pixels)
+    height, width = pixels.shape[0], pixels.shape[1]
+
+    magnitude = numpy.empty((height, width), numpy.int32)
+    for top in xrange(0, height, strip):
+        bottom = min(height, top + strip)
+        above, below = max(0, top - 1), min(height, bottom + 1)
+        part = strip_gradient(pixels[above:below])
+        magnitude[top:bottom] = part[top - above:bottom - above]
+
+    return magnitude
+
+def strip_gradient(pixels):
+    '''
+        Computes the gradient() magnitude of a whole height x width x 3
+        array at once, with its first and last rows as the border.
+
+        The 3x3 Prewitt masks are separable, so each one is applied as
+        a [-1 0 1] difference along one axis followed by a [1 1 1] sum
+        along the other.
+        The sums carry over from one channel to the next and every channel
+        adds the running total to the magnitude, just like the original
+        per-pixel loop did.
+    '''
+    pixels = numpy.asarray(pixels, numpy.int32)
+    height, width = pixels.shape[0], pixels.shape[1]
+
+    magnitude = numpy.empty((height, width), numpy.int32)
+    magnitude.fill(BORDER_MAGNITUDE)
+
+    if height > 2 and width > 2:
+        sumX = numpy.zeros((height-2, width-2), numpy.int32)
+        sumY = numpy.zeros((height-2, width-2), numpy.int32)
+        inner = numpy.zeros((height-2, width-2), numpy.int32)
+
+        for k in xrange(0, 3):
+            channel = pixels[:, :, k]
+
+            # vertical difference summed across the row
+            dy = channel[2:, :] - channel[:-2, :]
+            sumX += dy[:, :-2] + dy[:, 1:-1] + dy[:, 2:]
+
+            # horizontal difference summed down the column
+            dx = channel[:, :-2] - channel[:, 2:]
+            sumY += dx[:-2, :] + dx[1:-1, :] + dx[2:, :]
+
+            # approximate the magnitude of the gradient
+            inner += numpy.abs(sumX) + numpy.abs(sumY)
+
+        magnitude[1:-1, 1:-1] = inner
+
+    return magnitude
+
+@instrument.timed("threshold")
+def edges(magnitude, threshold):
+    '''
+        Thresholds a gradient magnitude array from gradient().
+        Theshold is what determines how much color change creates an edge.
+            Lower threshold means more edges will be detected.
+
+        Returns a boolean array which is True on the edges.
+        The magnitude only has to be computed once per image,
+        after that changing the threshold is just this comparison.
+    '''
+    return magnitude >= threshold
+
+def prewitt(pixels, threshold):
     '''
         This function creates the edges.
-        Pixels are the original image pixels.
-        Width and height are those stats for the image.
+        Pixels are the original image pixels as a height x width x 3 array.
         Theshold is what determines how much color change creates an edge.
             Lower threshold means more edges will be detected.
+
+        Returns a height x width boolean array which is True on the edges.
+    '''
+    return edges(gradient(pixels), threshold)
+
+def edge_rgb(edges):
+    '''
+        Turns a boolean edge array into a height x width x 3 array with
+        black edges on a white background.
+    '''
+    outpixels = numpy.empty(edges.shape + (3,), numpy.uint8)
+    outpixels.fill(255)
+    outpixels[edges] = 0
+    return outpixels
+
+@instrument.timed("edge image")
+def edge_image(edges):
+    '''
+        Turns a boolean edge array into a displayable RGB image with
+        black edges on a white background.
+    '''
+    return Image.fromarray(edge_rgb(edges), 'RGB')
+
+def neighbours(height, width):
+    '''
+        Returns two arrays of flat pixel indices (x + y * width) holding
+        every pair of pixels that touch, corners included.
+        Each pair shows up once: right, down, down-right and down-left.
+    '''
+    index = numpy.arange(height * width).reshape(height, width)
+
+    first, second = [], []
+    for a, b in (((slice(None), slice(None, -1)),
+                  (slice(None), slice(1, None))),
+                 ((slice(None, -1), slice(None)),
+                  (slice(1, None), slice(None))),
+                 ((slice(None, -1), slice(None, -1)),
+                  (slice(1, None), slice(1, None))),
+                 ((slice(None, -1), slice(1, None)),
+                  (slice(1, None), slice(None, -1)))):
+        first.append(index[a].ravel())
+        second.append(index[b].ravel())
+
+    return numpy.concatenate(first), numpy.concatenate(second)
+
+def join(size, first, second):
+    '''
+        Union-find done on whole arrays at once.
+        Size is the number of elements and every first[i], second[i]
+        pair is joined into the same set.
+
+        Returns an array giving the root of every element, which is the
+        smallest element of its set.
+
+        Every element starts as its own root; each round hooks every root
+        onto the smallest root it is paired with and then jumps pointers
+        until every element points straight at its root.
     '''
+    parent = numpy.arange(size)
+    while len(first):
+        rootA = parent[first]
+        rootB = parent[second]
+        joined = rootA != rootB
+        first, second = first[joined], second[joined]
+        if not len(first):
+            break
+        rootA, rootB = rootA[joined], rootB[joined]
+        numpy.minimum.at(parent, numpy.maximum(rootA, rootB),\
+                                 numpy.minimum(rootA, rootB))
+
+        # pointer jumping
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    return parent
+
+@instrument.timed("label")
+def label(edges, strip=STRIP):
+    '''
+        Labels every area enclosed by the edges in one pass, so that
+        clicking on the picture is only a lookup.
+
+        Takes the boolean edge array from edges().
+        Returns a height x width integer array holding 0 on the edges and
+        1, 2, 3... for the areas, numbered in the order they first show up
+        going across and down the picture. Pixels touching at the corners
+        are in the same area, the same as the old flood fill.
+
+        Each strip of rows is labeled on its own, numbering on from the
+        strips above, and then the areas that touch across the rows
+        between strips are joined. Labels in strips lower down always
+        first show up later, so the smallest label of each joined area
+        is the one it is numbered by, and the result is the same as
+        labeling the whole picture at once.
+    '''
+    height, width = edges.shape
+    labels = numpy.empty((height, width), numpy.int32)
+
+    count = 0
+    for top in xrange(0, height, strip):
+        bottom = min(height, top + strip)
+        part = strip_label(edges[top:bottom])
+        found = part.max()
+        part[part > 0] += count
+        labels[top:bottom] = part
+        count += found
+
+    # Pairs of labels that touch across the rows between strips:
+    # straight down, down-right and down-left
+    first, second = [], []
+    for row in xrange(strip, height, strip):
+        above, below = labels[row - 1], labels[row]
+        for a, b in ((above, below), (above[:-1], below[1:]),
+                     (above[1:], below[:-1])):
+            both = (a > 0) & (b > 0)
+            first.append(a[both])
+            second.append(b[both])
+    if not first:
+        return labels
 
-    xmask, ymask = get_prewitt_masks()
-  
-    # create a new greyscale image for the output
-    outimg = Image.new('RGB', (width, height))
-    outpixels = list(outimg.getdata())
-  
-    for y in xrange(height):
-        for x in xrange(width):
-            sumX, sumY, magnitude = 0, 0, 0
-
-            if y == 0 or y == height-1: magnitude = 10000 #magic number
-            elif x == 0 or x == width-1: magnitude = 10000 #magic number
-            else:
-                for k in xrange(0, 3):
-                    for i in xrange(-1, 2):
-                        for j in xrange(-1, 2):
-                            # convolve the image pixels with the Prewitt mask
-                            sumX += (pixels[x+i+(y+j)*width][k])\
-                                    * xmask[i+1, j+1]
-
-                            sumY += (pixels[x+i+(y+j)*width][k])\
-                                    * ymask[i+1, j+1]
-  
-                    # approximate the magnitude of the gradient
-                    magnitude += abs(sumX) + abs(sumY)
-                    if magnitude > 0:
-                        magnitude = magnitude
-  
-            if magnitude >= threshold: magnitude = 255
-            elif magnitude < threshold: magnitude = 0
-  
-            outpixels[x+y*width] = 255 - magnitude,\
-                                   255 - magnitude,\
-                                   255 - magnitude
-
-    outimg.putdata(outpixels)
-    return outimg 
-
-
-def getarea(pixels,width, height, xco, yco):
-    '''
-        Takes the image of the edges, its width and height,
+    root = join(count + 1, numpy.concatenate(first),
+                numpy.concatenate(second))
+    number = numpy.cumsum(root == numpy.arange(count + 1)) - 1
+    number = number[root].astype(numpy.int32)
+    for top in xrange(0, height, strip):
+        labels[top:top + strip] = number[labels[top:top + strip]]
+    return labels
+
+def strip_label(edges):
+    '''
+        Does what label() does to a whole edge array at once.
+    '''
+    height, width = edges.shape
+    free = ~edges.ravel()
+
+    first, second = neighbours(height, width)
+    both = free[first] & free[second]
+    parent = join(height * width, first[both], second[both])
+
+    labels = numpy.zeros(height * width, numpy.int32)
+    labels[free] = numpy.unique(parent[free], return_inverse=True)[1] + 1
+    return labels.reshape(height, width)
+
+@instrument.timed("getarea")
+def getarea(labels, xco, yco):
+    '''
+        Takes the labels of the edge image from label()
             and the coordinates of the mouseclick.
                 
-        It returns the area enclosed by the edges.
+        It returns the area enclosed by the edges as a regions.Area,
+        or None if the click was on an edge.
     '''
-    if pixels[xco + yco * width] != (255, 255, 255):
-        return ();
-    
-    area        = [(xco,yco)]
-    alreadyseen = {(xco,yco):pixels[xco + yco * width] }
-    
-    print pixels[xco + yco * width]
-    
-    for (xco,yco) in area:
-        
-        for i in xrange(-1,2):
-            for j in xrange(-1,2):
-                if pixels[xco+i + (yco+j) * width] == (255,255,255):
-                    if (xco+i,yco+j) not in alreadyseen:
-                        alreadyseen[(xco+i,yco+j)]=pixels[xco+i +\
-                                                          (yco+j) *\
-                                                          width]
-                        area.append((xco+i,yco+j))
+    number = labels[yco, xco]
+    if number == 0:
+        return None
 
-    return alreadyseen.keys()
+    return regions.from_mask(labels == number)
 
-def highlight(pixels, width, height, area, color):
+@instrument.timed("highlight")
+def highlight(edges, area, color):
     '''
-        Pixels are from the edge image.
-        The area is the list of lists containing the points that are going to be
+        Edges is the boolean edge array.
+        The area is the list of regions.Area that are going to be
             highlighted.
     '''
-    outpixels = pixels
+    outpixels = edge_rgb(edges)
     
     for i in area:
-        for (x,y) in i:
-            outpixels[x + y * width] = color
+        i.paint(outpixels, color)
         
-    outimg = Image.new('RGB', (width, height))
-    outimg.putdata(outpixels)
-    return outimg
+    return Image.fromarray(outpixels, 'RGB')
+
+@instrument.timed("highlight")
+def highlight_box(edges, area, color, box):
+    '''
+        Same as highlight, but only makes the part of the picture inside
+        box, (left, top, right, bottom), so redrawing a small change
+        doesn't cost a whole picture.
+    '''
+    left, top, right, bottom = box
+    outpixels = edge_rgb(edges[top:bottom, left:right])
+
+    for i in area:
+        outpixels[i.placed(box)] = color
+
+    return Image.fromarray(outpixels, 'RGB')
 
-def average_color(pixels, width, height, area):
+@instrument.timed("average color")
+def average_color(pixels, area):
     '''
         Calculates the average color in an area of pixels.
+        Pixels is the pixelbuffer.PixelBuffer or height x width x 3 RGB
+        array of the picture and the area is the list of regions.Area to
+        average over.
         This is called before the highlight function.
     '''
+    pixels = pixelbuffer.rgb(pixels)
     r,g,b = 0, 0, 0
     size = 0
     for i in area:
-        for(x,y) in i:
-            r += pixels[x + y * width][0]
-            g += pixels[x + y * width][1]
-            b += pixels[x + y * width][2]
-        size += len(i)
+        selected = i.pixels(pixels)
+        sums = selected.sum(axis=0)
+        r += int(sums[0])
+        g += int(sums[1])
+        b += int(sums[2])
+        size += len(selected)
 
     if size == 0:
         return
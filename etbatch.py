@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+    Makes the .tm and .col files of a saved EasierTrain session without
+    starting the GUI, for build scripts and machines with no display.
+
+    $ python etbatch.py [options] <session.et> <img-dir>
+
+    Only the session and generator modules are used, so neither Tkinter
+    nor ImageTk is ever imported.
+'''
+import sys
+import optparse
+import multiprocessing
+import generator
+import session
+import instrument
+
+def parse_shape(text):
+    '''
+        Turns "16x64x64" into (16, 64, 64).
+    '''
+    try:
+        shape = tuple([int(size) for size in text.lower().split("x")])
+        if len(shape) != 3:
+            raise ValueError
+        generator.bin_shifts(shape)
+    except ValueError:
+        raise optparse.OptionValueError(
+            "resolution must be YxUxV with powers of two up to 256, not "
+            + text)
+    return shape
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage="%prog [options] <session.et> <img-dir>")
+    parser.add_option("-t", "--tm", dest="tmpath", default="default.tm",
+                      help="where to write the threshold map "
+                           "[default: %default]")
+    parser.add_option("-c", "--col", dest="colpath", default="default.col",
+                      help="where to write the color names "
+                           "[default: %default]")
+    parser.add_option("-r", "--resolution", dest="resolution",
+                      default="%dx%dx%d" % (generator.Ymax, generator.Umax,
+                                            generator.Vmax),
+                      help="Y, U and V bins of the color cube "
+                           "[default: %default]")
+    parser.add_option("-j", "--workers", dest="workers", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="processes to make the histograms with "
+                           "[default: %default]")
+    parser.add_option("--trace", dest="trace", metavar="FILE",
+                      help="time the work and write a Chrome trace to FILE, "
+                           "see instrument.py")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error("need a session file and an image directory")
+    try:
+        shape = parse_shape(options.resolution)
+    except optparse.OptionValueError, e:
+        parser.error(str(e))
+    if options.workers < 1:
+        parser.error("need at least one worker")
+
+    if options.trace:
+        instrument.enable(options.trace)
+
+    sessionpath, imgdir = args
+    colors, thresholds = session.load(sessionpath, imgdir)
+
+    generator.generate_color_space(colors, imgdir,
+                                   tmpath=options.tmpath,
+                                   colpath=options.colpath,
+                                   shape=shape,
+                                   workers=options.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+'''
+    On-disk cache of the gradient magnitude and component tree of pictures.
+
+    Edge detection and the component tree take longer than anything else
+    done to a picture, and their results only depend on the contents of the
+    file. They are saved as .npy files in a cache directory, named after the
+    SHA-1 digest of the picture file, and memory-mapped back in next time,
+    so a picture seen before starts straight away, even after a restart.
+    When the directory grows past its size limit, the files that were used
+    least recently are removed.
+'''
+
+import os
+import hashlib
+import tempfile
+import threading
+import numpy
+import edge
+import components
+import pyramid
+import instrument
+
+# Where the cache lives and how big it may get, in bytes
+DIRECTORY = os.path.join(os.path.expanduser("~"), ".easiertrain", "fields")
+LIMIT = 512 * 1024 * 1024
+
+# Bumped whenever the arrays that are saved change
+VERSION = "1"
+
+class FieldCache:
+    '''
+        A directory of arrays, each saved under a key and a name.
+    '''
+    def __init__(self, directory=DIRECTORY, limit=LIMIT):
+        self.directory = directory
+        self.limit = limit
+        self.lock = threading.Lock() # held while evicting
+
+    def filename(self, key, name):
+        return os.path.join(self.directory,
+                            key + "." + name + ".v" + VERSION + ".npy")
+
+    def load(self, key, name):
+        '''
+            Returns the array saved under key and name, memory-mapped
+            read-only, or None if there isn't one.
+        '''
+        filename = self.filename(key, name)
+        try:
+            array = numpy.load(filename, mmap_mode='r')
+            os.utime(filename, None) # mark it as recently used
+        except (IOError, OSError, ValueError):
+            instrument.count("field cache misses")
+            return None
+        instrument.count("field cache hits")
+        return array
+
+    def save(self, key, name, array):
+        '''
+            Saves an array under key and name. Failing to save only means
+            it has to be worked out again next time, so errors are ignored.
+        '''
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write to a new file first so nobody maps a half written one
+            handle, temp = tempfile.mkstemp(".npy", "", self.directory)
+            out = os.fdopen(handle, "wb")
+            try:
+                numpy.save(out, numpy.asarray(array))
+            finally:
+                out.close()
+
+            filename = self.filename(key, name)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp, filename)
+        except (IOError, OSError):
+            return
+
+        self.evict()
+
+    def evict(self):
+        '''
+            Removes the least recently used files until the cache is back
+            under its size limit.
+        '''
+        self.lock.acquire()
+        try:
+            files = []
+            used = 0
+            for item in os.listdir(self.directory):
+                filename = os.path.join(self.directory, item)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filename))
+                used += stat.st_size
+
+            files.sort()
+            for mtime, size, filename in files:
+                if used <= self.limit:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                used -= size
+        finally:
+            self.lock.release()
+
+# The cache shared by the whole program
+cache = FieldCache()
+
+# { path : (mtime, size, digest) } so unchanged files aren't read again
+digests = dict()
+
+def file_key(path):
+    '''
+        Returns the SHA-1 hex digest of the contents of a file.
+    '''
+    stat = os.stat(path)
+    known = digests.get(path)
+    if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+        return known[2]
+
+    digest = hashlib.sha1()
+    picture = open(path, "rb")
+    try:
+        block = picture.read(1 << 20)
+        while block:
+            digest.update(block)
+            block = picture.read(1 << 20)
+    finally:
+        picture.close()
+
+    digests[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+    return digests[path][2]
+
+def level_name(name, level):
+    '''
+        Returns the name an array of a pyramid level is saved under.
+        Level 0 arrays keep the names they always had.
+    '''
+    if level == 0:
+        return name
+    return "level%d-%s" % (level, name)
+
+def cached_gradient(path, level=0):
+    '''
+        Returns the edge.gradient() magnitude of a picture, or of a
+        pyramid level of it, if it is in the cache, or None.
+    '''
+    return cache.load(file_key(path), level_name("magnitude", level))
+
+def gradient(path, level=0):
+    '''
+        Returns the edge.gradient() magnitude of a picture, or of a
+        pyramid level of it, from the cache if it is there.
+    '''
+    key = file_key(path)
+    name = level_name("magnitude", level)
+    magnitude = cache.load(key, name)
+    if magnitude is None:
+        magnitude = edge.gradient(pyramid.level_pixels(path, level))
+        cache.save(key, name, magnitude)
+    return magnitude
+
+def cached_component_tree(path, magnitude, level=0):
+    '''
+        Returns the components.ComponentTree of a picture, or of a pyramid
+        level of it, with the given magnitude if it is in the cache,
+        or None.
+    '''
+    key = file_key(path)
+    saved = dict()
+    for name in components.ARRAYS:
+        saved[name] = cache.load(key, level_name("tree-" + name, level))
+        if saved[name] is None:
+            return None
+    return components.ComponentTree(magnitude, saved)
+
+def component_tree(path, magnitude, progress=None, level=0):
+    '''
+        Returns the components.ComponentTree of a picture, or of a pyramid
+        level of it, with the given magnitude, from the cache if it is
+        there. Progress is passed on to the tree if it has to be built.
+    '''
+    tree = cached_component_tree(path, magnitude, level)
+    if tree is None:
+        with instrument.span("component tree"):
+            tree = components.ComponentTree(magnitude, progress=progress)
+        key = file_key(path)
+        for name, array in tree.arrays().items():
+            cache.save(key, level_name("tree-" + name, level), array)
+    return tree
@@ -4,12 +4,31 @@ Created on Apr 30, 2009
 @author: Nathan
 '''
 
-import Image
+import numpy
+import multiprocessing
+import pixelbuffer
+import instrument
 
 Vmax = 64
 Umax = 64
 Ymax = 16
 
+# Reach of the splat around each pixel in the default color space,
+# in bins along Y, U and V
+Yreach = 2
+Ureach = 4
+Vreach = 4
+
+# The colorspace is one contiguous uint64 array of shape
+# (colors+1, Ymax, Umax, Vmax), indexed colorspace[color][Y][U][V].
+# Entry 0 along the first axis is "unclassified" and stays zero, so a point
+# no color reaches keeps color 0. uint64 because a big area can put more
+# than 2**32 / 10000 pixels into a single bin.
+# The histograms of the colors are Ymax x Umax x Vmax arrays of uint32
+# pixel counts.
+# Other resolutions can be asked for with a (Y, U, V) shape, as long as
+# every size is a power of two no bigger than 256.
+
 
 # The function adds less to a given color point if 
 # This is an attempt to reduce the effect of a large area so it won't
@@ -18,10 +37,14 @@ Ymax = 16
 # surrounding color space
 
 
-def generate_color_space(colors, imgdir):
+@instrument.timed("generate color space")
+def generate_color_space(colors, imgdir, tmpath="default.tm",
+                         colpath="default.col", shape=None, workers=1,
+                         progress=None):
     '''
-        Generates the .tm file.
-        The file has a few lines of header followed by a 16*64*64 data block.
+        Generates the .tm and .col files, at tmpath and colpath.
+        The file has a few lines of header followed by a 16*64*64 data block,
+        or whatever shape was asked for.
         Each position of [Y][U][V] has a byte representing which color that 
         point falls under.
         
@@ -33,10 +56,41 @@ def generate_color_space(colors, imgdir):
         winner ( or undefined if no color claims that spot )
         
         color data comes in as a list of:
-            [ [ { picture_path : Area } , average_color_tuple , colorname] ]
-        with Area being the list of list of adjacent points in a picture.
+            [ [ { picture_path : Area } , average_color_tuple , colorname,
+                histogram ] ]
+        with Area being the regions.Area of all the selected pixels
+        in a picture, and histogram the color_histogram() of all of them.
+        Colors without a histogram get one here, which means going
+        through their pictures; colors that have one never touch a pixel.
+        Histograms of another shape are made again for this one,
+        but not kept.
+        Making histograms is split over that many worker processes,
+        see color_histograms(). Progress is called along the way with how
+        far along it is; neither file is written until everything is
+        worked out, so it can stop the work by raising an exception.
     '''
-    colfile = open("default.col", 'w')
+    if shape is None:
+        shape = (Ymax, Umax, Vmax)
+
+    histograms = [None] * len(colors)
+    missing = [] # colors without a histogram of this shape
+    for colorindex in xrange(len(colors)):
+        color = colors[colorindex]
+        if len(color) < 4 or color[3].shape != tuple(shape):
+            missing.append(colorindex)
+        else:
+            histograms[colorindex] = color[3]
+
+    made = color_histograms([colors[i] for i in missing], shape, workers,
+                            progress)
+    for colorindex, hist in zip(missing, made):
+        histograms[colorindex] = hist
+        if len(colors[colorindex]) < 4 and tuple(shape) == (Ymax, Umax, Vmax):
+            colors[colorindex].append( hist )
+
+    winners = color_table( histograms, shape )
+
+    colfile = open(colpath, 'w')
     
     colfile.write("0 (128 128 128) \"unclassified\" 8 1.00")
     colfile.write(chr(10))
@@ -61,88 +115,207 @@ def generate_color_space(colors, imgdir):
     
     
     
-    # Make the list of colors for each YUV point
-    
-    colorspace = [ [ [[0 for w in xrange(0,len(colors)+1)] \
-                         for x in xrange(0,Vmax)]          \
-                         for y in xrange(0,Umax)]          \
-                         for z in xrange(0,Ymax)]
-    
-    tmfile = open("default.tm", 'w')
-    
+    colfile.close()
+
     #Header information for the tm file.
-    tmfile.write("TMAP")
-    tmfile.write(chr(10))
-    tmfile.write("YUV8")
-    tmfile.write(chr(10))
-    tmfile.write(str(Ymax)+" "+str(Umax)+" "+str(Vmax))
-    tmfile.write(chr(10))
+    header = "TMAP" + chr(10) + "YUV8" + chr(10)\
+             + " ".join([str(size) for size in shape]) + chr(10)
+
+    # The data block goes Y, then V, then U, so U changes fastest
+    with instrument.span("write tm"):
+        tmfile = open(tmpath, 'wb')
+        tmfile.write(header + winners.transpose(0, 2, 1).tostring())
+        tmfile.close()
+    print "done"
+
+def bin_shifts(shape):
+    '''
+        Returns how far the 8 bit Y, U and V values are shifted right to
+        get their bins in a color space of the given shape.
+        Raises ValueError for sizes that aren't a power of two up to 256.
+    '''
+    shifts = []
+    for size in shape:
+        shift = 8
+        while shift > 0 and (256 >> shift) < size:
+            shift -= 1
+        if (256 >> shift) != size:
+            raise ValueError("color space sizes must be powers of two "
+                             "up to 256, not " + str(size))
+        shifts.append(shift)
+    return shifts
+
+def empty_histogram(shape=None):
+    '''
+        Returns a histogram with nothing in it.
+    '''
+    if shape is None:
+        shape = (Ymax, Umax, Vmax)
+    return numpy.zeros(shape, numpy.uint32)
+
+def area_histogram(areas, shape=None):
+    '''
+        Counts all the selected pixels of a color into one histogram.
+        Areas is the { picture_path : Area } dictionary of the color.
+    '''
+    hist = empty_histogram(shape)
+    for picture in areas:
+        hist += color_histogram( areas[picture],
+                                 pixelbuffer.from_file( picture ), shape )
+    return hist
+
+@instrument.timed("histograms")
+def color_histograms(colors, shape=None, workers=1, progress=None):
+    '''
+        Makes the histograms of a list of colors, in the same order.
+        There is one task per picture, covering every color with an area
+        in it, so each picture is only looked at once. With more than one
+        worker the tasks are handed to a pool of processes and the partial
+        histograms are added up here. Counts add up the same in any order,
+        so the result doesn't depend on the number of workers.
+        Progress, if given, is called with the fraction of pictures done.
+    '''
+    if shape is None:
+        shape = (Ymax, Umax, Vmax)
+    histograms = [empty_histogram(shape) for color in colors]
+
+    byPicture = dict()
+    for colorindex in xrange(len(colors)):
+        areas = colors[colorindex][0]
+        for picture in areas:
+            byPicture.setdefault(picture, []).append(\
+                (colorindex, areas[picture]))
+    tasks = [(picture, byPicture[picture], shape)\
+             for picture in sorted(byPicture)]
+
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        results = pool.imap_unordered(picture_histograms, tasks)
+    else:
+        results = map(picture_histograms, tasks)
+
+    try:
+        done = 0
+        for result in results:
+            for colorindex, hist in result:
+                histograms[colorindex] += hist
+            done += 1
+            if progress is not None:
+                progress(float(done) / len(tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return histograms
+
+@instrument.timed("picture histograms")
+def picture_histograms(task):
+    '''
+        Worker side of color_histograms(). Task is
+            ( picture_path, [ (colorindex, Area) ], shape )
+        Returns [ (colorindex, histogram) ].
+    '''
+    picture, areas, shape = task
+    pixels = pixelbuffer.from_file( picture )
+    return [(colorindex, color_histogram( area, pixels, shape ))\
+            for colorindex, area in areas]
+
+@instrument.timed("color table")
+def color_table(histograms, shape=None):
+    '''
+        Picks the winning color of every [Y][U][V] point.
+        Histograms are those of the colors, in palette order,
+        all of the given shape.
+        Returns a uint8 array of color numbers of that shape.
+    '''
+    if shape is None:
+        shape = (Ymax, Umax, Vmax)
+    colorspace = numpy.zeros((len(histograms)+1,) + tuple(shape),\
+                             numpy.uint64)
     
     colorindex = 0
     
-    for color in colors:
+    for hist in histograms:
         colorindex += 1
-        totalarea = 0
-        for picture in color[0]:
-            for area in color[0][picture]:
-                totalarea += len(area)
-                
-        for picture in color[0]:
-            img = Image.open( picture ).convert("YCbCr")
-            
-            pixels = list( img.getdata() )
-            width, height = img.size
-            for area in color[0][picture]:
-                for(x,y) in area:
-                    
-                    #Both Tekkotsu and Python Image Library has it in YCrCb order,
-                    
-                    colorspace \
-                    [pixels[x + y * width][0]>>4] \
-                    [pixels[x + y * width][1]>>2] \
-                    [pixels[x + y * width][2]>>2] \
-                    [colorindex] += 10000 #/totalarea
-
-                    # Fill in colorspace around a given instance.
-                    #
-                        
-                    for Y in xrange(-2,2):
-                        for U in xrange(-4,4):
-                            for V in xrange(-4,4):
-                                try:
-                                    
-                                    colorspace                        \
-                                    [(pixels[x + y * width][0]>>4)+Y] \
-                                    [(pixels[x + y * width][1]>>2)+U] \
-                                    [(pixels[x + y * width][2]>>2)+V] \
-                                    [colorindex] += 1 #/totalarea
-                                    
-                                except IndexError:
-                                    pass
-                                        
-                                    
-        
-    for Y in xrange(0,Ymax):
-        for V in xrange(0,Vmax):
-            for U in xrange(0,Umax):
-
-                
-#For each point in YUV space, pick the best candidate print it as a char
-                tmfile.write(\
-                             chr(\
-                             list_int_max(colorspace[Y][U][V])\
-                             )\
-                             )
-    print "done"
+        colorspace[colorindex] = splat( hist )
+
+    # For each point in YUV space, pick the best candidate.
+    # argmax takes the first of any ties, and nothing beats the
+    # unclassified zeros unless it adds something.
+    return colorspace.argmax(axis=0).astype(numpy.uint8)
 
-def list_int_max(list):
+def color_histogram(area, pixels, shape=None):
     '''
-        finds the position on a list with the highest value 
+        Counts how many pixels of an area fall in each [Y][U][V] bin.
+        Pixels is the pixelbuffer.PixelBuffer of the picture, or its
+        height x width x 3 YCbCr array.
+        Returns a Ymax x Umax x Vmax array of counts, or one of shape.
     '''
-    
-    maxentry = 0
-    for i in xrange(0, len(list)):
-        if list[i] > list[maxentry]:
-            maxentry = i
-    
-    return maxentry
+    return pixel_histogram(area.pixels(pixelbuffer.ycbcr(pixels)), shape)
+
+def pixel_histogram(selected, shape=None):
+    '''
+        Counts how many of an n x 3 array of YCbCr pixels
+        fall in each [Y][U][V] bin.
+    '''
+    if shape is None:
+        shape = (Ymax, Umax, Vmax)
+    Yshift, Ushift, Vshift = bin_shifts(shape)
+
+    #Both Tekkotsu and Python Image Library has it in YCrCb order,
+    instrument.count("pixels histogrammed", len(selected))
+    selected = selected.astype(int)
+    index = ((selected[:,0]>>Yshift) * shape[1] + (selected[:,1]>>Ushift))\
+            * shape[2] + (selected[:,2]>>Vshift)
+    return numpy.bincount(index, minlength=shape[0]*shape[1]*shape[2])\
+                .astype(numpy.uint32).reshape(shape)
+
+def spread(hist, axis, low, high):
+    '''
+        Adds every bin of hist to the bins low up to high-1 steps away from
+        it along one axis.
+        Steps that go below 0 wrap around to the top of the axis and steps
+        that go past the top are dropped. That is exactly what the old
+        nested list indexing did with its try/except IndexError.
+    '''
+    size = hist.shape[axis]
+    out = numpy.zeros_like(hist)
+
+    # Work on views with the axis first
+    src = numpy.rollaxis(hist, axis)
+    dst = numpy.rollaxis(out, axis)
+    for d in xrange(low, high):
+        # bins that stay inside the axis
+        first, last = max(0, -d), min(size, size-d)
+        if first < last:
+            dst[first+d:last+d] += src[first:last]
+
+        # bins that land on a negative index, which wraps
+        first, last = max(0, -size-d), min(size, -d)
+        if first < last:
+            dst[first+d+size:last+d+size] += src[first:last]
+
+    return out
+
+@instrument.timed("splat")
+def splat(hist):
+    '''
+        Turns the histogram of a color into its weight on every [Y][U][V]
+        point.
+        Each pixel adds 10000 to its own point and 1 to every point in the
+        [-2,2) x [-4,4) x [-4,4) box around it. That box is one 3D
+        convolution, and since it is a box it is done one axis at a time.
+        In other shapes the box covers the same part of the color space.
+    '''
+    reach = []
+    for size, default, bins in zip(hist.shape, (Ymax, Umax, Vmax),
+                                   (Yreach, Ureach, Vreach)):
+        reach.append(max(1, bins * size // default))
+
+    hist = hist.astype(numpy.uint64)
+    neighbourhood = hist
+    for axis in xrange(3):
+        neighbourhood = spread(neighbourhood, axis, -reach[axis], reach[axis])
+    return hist * 10000 + neighbourhood #/totalarea
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''
+    Decoded pictures, shared by everything that needs their pixels.
+
+    Opening a picture and converting it costs far more than anything done
+    with the pixels afterwards, and the same picture is wanted over and over:
+    by the display, by every color that has an area in it, and again on
+    every save. The store keeps the decoded RGB and YCbCr pixels of recently
+    used pictures as read-only arrays, keyed by path and modification time
+    so an edited file is decoded again. Once the arrays take up more than
+    the memory limit, the least recently used are let go.
+    The store can be used from more than one thread.
+'''
+
+import os
+import re
+import threading
+import Image # PIL
+import numpy
+import instrument
+
+# Default memory limit of the store, in bytes
+LIMIT = 256 * 1024 * 1024
+
+# How the files PIL reads most often start
+MAGIC = ( "\xff\xd8\xff", # JPEG
+          "\x89PNG\r\n\x1a\n",
+          "GIF87a", "GIF89a",
+          "BM", # Windows bitmap
+          "II*\x00", "MM\x00*", # TIFF
+          "P1", "P2", "P3", "P4", "P5", "P6" ) # PBM, PGM, PPM
+
+class ImageStore:
+    '''
+        Keeps decoded pixels of pictures up to limit bytes.
+    '''
+    def __init__(self, limit=LIMIT):
+        self.limit = limit
+        self.used = 0
+        self.planes = dict() # (path, mtime, mode) : pixel array
+        self.recent = [] # keys of self.planes, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, path, mode):
+        '''
+            Returns the pixels of a picture converted to a PIL mode
+            as a read-only height x width (x channels) array.
+        '''
+        key = (path, os.path.getmtime(path), mode)
+        self.lock.acquire()
+        try:
+            if key in self.planes:
+                self.recent.remove(key)
+                self.recent.append(key)
+                instrument.count("imagestore hits")
+                return self.planes[key]
+        finally:
+            self.lock.release()
+
+        # Decode without holding the lock, so other threads can carry on
+        with instrument.span("decode", mode=mode):
+            img = Image.open(path)
+            img.load()
+        with instrument.span("convert", mode=mode):
+            pixels = numpy.asarray(img.convert(mode))
+        pixels.flags.writeable = False
+        instrument.count("imagestore misses")
+
+        self.lock.acquire()
+        try:
+            # Another thread may have decoded it in the meantime
+            if key in self.planes:
+                return self.planes[key]
+
+            # The file changed, so what was kept of it is no good any more
+            for old in [k for k in self.planes
+                        if k[0] == path and k[1] != key[1]]:
+                self.drop(old)
+
+            self.planes[key] = pixels
+            self.recent.append(key)
+            self.used += pixels.nbytes
+
+            # Always keep the one just asked for, even if it is over the limit
+            while self.used > self.limit and len(self.recent) > 1:
+                self.drop(self.recent[0])
+        finally:
+            self.lock.release()
+
+        return pixels
+
+    def drop(self, key):
+        '''
+            Lets go of one array of the store. The lock must be held.
+        '''
+        self.used -= self.planes.pop(key).nbytes
+        self.recent.remove(key)
+
+    def clear(self):
+        '''
+            Lets go of everything in the store.
+        '''
+        self.lock.acquire()
+        try:
+            self.planes = dict()
+            self.recent = []
+            self.used = 0
+        finally:
+            self.lock.release()
+
+# The store shared by the whole program
+store = ImageStore()
+
+def looks_like_picture(path):
+    '''
+        Guesses whether PIL can read a file from its first few bytes,
+        or failing that from its extension, without decoding anything.
+        A file that only looks like a picture fails when it is opened.
+    '''
+    try:
+        header = open(path, "rb").read(16)
+    except IOError:
+        return False
+    for magic in MAGIC:
+        if header.startswith(magic):
+            return True
+
+    Image.init() # loads the plugins, only does anything the first time
+    return os.path.splitext(path)[1].lower() in Image.EXTENSION
+
+def picture_order(name):
+    '''
+        Sort key for file names that puts frame2.jpg before frame10.jpg.
+    '''
+    parts = re.split(r"(\d+)", name.lower())
+    for i in xrange(1, len(parts), 2):
+        parts[i] = int(parts[i])
+    return parts
+
+def pictures(imgdir):
+    '''
+        Goes through the files of a directory that look like pictures,
+        in picture_order(). Directories are left out.
+    '''
+    for item in sorted(os.listdir(imgdir), key=picture_order):
+        path = os.path.join(imgdir, item)
+        if os.path.isfile(path) and looks_like_picture(path):
+            yield path
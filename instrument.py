@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+    Timing and counting of the slow parts of EasierTrain.
+
+    Set the EASIERTRAIN_TRACE environment variable to a file name, or give
+    etbatch.py --trace, and every span of work that is timed here is
+    recorded. When the program exits they are written to that file in the
+    Chrome trace format (open it at chrome://tracing), and a table of how
+    many times each span ran, how long they took altogether and their
+    median and 95th percentile times is printed.
+
+    Parts of the code are timed with
+        with instrument.span("name"):
+            ...
+    or whole functions with the @instrument.timed("name") decorator, and
+    things are counted with instrument.count("name", n). When tracing is
+    off each of these is one check of a global and nothing else.
+
+    Work done in the worker processes of generator.color_histograms()
+    isn't recorded, only the time the main process spends waiting on it.
+'''
+
+import os
+import sys
+import time
+import json
+import thread
+import atexit
+import functools
+import threading
+
+# Most spans kept for the trace file; the summary goes on counting
+MAX_EVENTS = 1000000
+
+enabled = False
+filename = None # where the trace goes
+started = time.time()
+
+lock = threading.Lock()
+events = [] # Chrome trace events of the spans, in the order they ended
+times = dict() # name : [seconds of each span]
+counters = dict() # name : total
+
+class Span:
+    '''
+        Times the work done inside a with statement.
+    '''
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        seconds = time.time() - self.start
+        event = {"name": self.name, "ph": "X", "pid": os.getpid(),
+                 "tid": thread.get_ident(),
+                 "ts": (self.start - started) * 1e6, "dur": seconds * 1e6}
+        if self.args:
+            event["args"] = self.args
+
+        lock.acquire()
+        try:
+            times.setdefault(self.name, []).append(seconds)
+            if len(events) < MAX_EVENTS:
+                events.append(event)
+        finally:
+            lock.release()
+        return False
+
+class NoSpan:
+    '''
+        Stands in for Span when tracing is off.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        return False
+
+nothing = NoSpan()
+
+def span(name, **args):
+    '''
+        Returns something to time a with statement as name. Args are
+        shown with the span in the trace.
+    '''
+    if not enabled:
+        return nothing
+    return Span(name, args)
+
+def timed(name):
+    '''
+        Decorator that times every call of a function as name.
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def timedCall(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name, None):
+                return func(*args, **kwargs)
+        return timedCall
+    return decorate
+
+def count(name, n=1):
+    '''
+        Adds n to the counter called name.
+    '''
+    if not enabled:
+        return
+    lock.acquire()
+    try:
+        counters[name] = counters.get(name, 0) + n
+    finally:
+        lock.release()
+
+def enable(trace):
+    '''
+        Starts recording; the trace is written to the file trace at exit.
+    '''
+    global enabled, filename
+    if not enabled:
+        atexit.register(finish)
+    enabled = True
+    filename = trace
+
+def percentile(values, fraction):
+    '''
+        Returns the value that fraction of the sorted values are under.
+    '''
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def summary():
+    '''
+        Returns the table of the spans and counters as a string.
+    '''
+    lines = ["%-28s %7s %10s %9s %9s" % ("span", "count", "total ms",
+                                         "p50 ms", "p95 ms")]
+    lock.acquire()
+    try:
+        for name in sorted(times):
+            spans = sorted(times[name])
+            lines.append("%-28s %7d %10.1f %9.2f %9.2f"
+                         % (name, len(spans), sum(spans) * 1000,
+                            percentile(spans, 0.5) * 1000,
+                            percentile(spans, 0.95) * 1000))
+        if counters:
+            lines.append("")
+            lines.append("%-28s %7s" % ("counter", "total"))
+            for name in sorted(counters):
+                lines.append("%-28s %7d" % (name, counters[name]))
+    finally:
+        lock.release()
+    return "\n".join(lines)
+
+def write(trace):
+    '''
+        Writes what has been recorded so far to the file trace.
+    '''
+    lock.acquire()
+    try:
+        out = list(events)
+        now = (time.time() - started) * 1e6
+        for name in counters:
+            out.append({"name": name, "ph": "C", "pid": os.getpid(),
+                        "ts": now, "args": {"total": counters[name]}})
+    finally:
+        lock.release()
+
+    traceFile = open(trace, "w")
+    try:
+        json.dump({"traceEvents": out, "displayTimeUnit": "ms"}, traceFile)
+    finally:
+        traceFile.close()
+
+def finish():
+    '''
+        Writes the trace and prints the summary. Runs at exit.
+    '''
+    if not enabled or filename is None:
+        return
+    try:
+        write(filename)
+    except(IOError):
+        print >> sys.stderr, "Failed to write", filename
+    print >> sys.stderr, summary()
+    print >> sys.stderr, "Trace written to", filename
+
+if os.environ.get("EASIERTRAIN_TRACE"):
+    enable(os.environ["EASIERTRAIN_TRACE"])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+    One way of handing the pixels of a picture around.
+
+    A PixelBuffer gives the RGB and YCbCr pixels of a picture as read-only
+    height x width x 3 uint8 NumPy arrays, made straight from the bytes PIL
+    decodes to, with no Python object per pixel. A 640x480 picture is about
+    900 KB per plane. Each plane is only made the first time it is asked
+    for. Buffers of picture files take their planes from the shared
+    imagestore, so every buffer of the same file shares the same bytes.
+
+    The functions that take pixels (edge.gradient, edge.average_color,
+    generator.color_histogram, colorstats.measure) take a PixelBuffer,
+    or a plain array of the plane they need.
+'''
+
+import numpy
+import imagestore
+import instrument
+
+class PixelBuffer:
+    '''
+        The pixels of a PIL image, or of the picture file at path.
+    '''
+    def __init__(self, img=None, path=None):
+        self.img = img
+        self.path = path
+        self.planes = dict() # mode : array, for buffers of images
+
+    def plane(self, mode):
+        '''
+            Returns the pixels converted to a PIL mode as a read-only array.
+        '''
+        if self.path is not None:
+            return imagestore.store.get(self.path, mode)
+
+        if mode not in self.planes:
+            with instrument.span("convert", mode=mode):
+                pixels = numpy.asarray(self.img.convert(mode))
+            pixels.flags.writeable = False
+            self.planes[mode] = pixels
+        return self.planes[mode]
+
+    def rgb(self):
+        return self.plane("RGB")
+
+    def ycbcr(self):
+        return self.plane("YCbCr")
+
+def from_image(img):
+    '''
+        Returns a buffer of a PIL image.
+    '''
+    return PixelBuffer(img=img)
+
+def from_file(path):
+    '''
+        Returns a buffer of a picture file, decoded through the imagestore.
+    '''
+    return PixelBuffer(path=path)
+
+def rgb(pixels):
+    '''
+        Returns the RGB plane of a buffer, or the pixels as they are if
+        they already are an array.
+    '''
+    if isinstance(pixels, PixelBuffer):
+        return pixels.rgb()
+    return pixels
+
+def ycbcr(pixels):
+    '''
+        Returns the YCbCr plane of a buffer, or the pixels as they are if
+        they already are an array.
+    '''
+    if isinstance(pixels, PixelBuffer):
+        return pixels.ycbcr()
+    return pixels
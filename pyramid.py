@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+    Reduced size versions of big pictures, for quick previews.
+
+    Level 0 of a picture is the picture itself and every level after that
+    is half the width and height of the one before, each pixel the average
+    of the 2x2 pixels under it. A picture is shown and worked on at the
+    first level no bigger than PREVIEW_PIXELS, so finding its edges and
+    areas while the slider moves takes about the same time however big it
+    is. Pixel (x,y) of level n covers the 2**n x 2**n pixels of the
+    picture from (x * 2**n, y * 2**n).
+'''
+
+import numpy
+import Image # PIL
+import pixelbuffer
+import instrument
+
+# Pictures with more pixels than this are previewed at a smaller level
+PREVIEW_PIXELS = 1024 * 768
+
+def level_for(width, height, limit=None):
+    '''
+        Returns the first level of a width x height picture that is no
+        bigger than limit, PREVIEW_PIXELS if not given.
+    '''
+    if limit is None:
+        limit = PREVIEW_PIXELS
+    level = 0
+    while (width >> level) * (height >> level) > limit:
+        level += 1
+    return level
+
+def picture_level(path):
+    '''
+        Returns the level a picture file is previewed at. Only the header
+        of the file is read.
+    '''
+    width, height = Image.open(path).size
+    return level_for(width, height)
+
+def reduce(pixels):
+    '''
+        Returns the next level of a height x width x 3 array. An odd last
+        row or column is left out.
+    '''
+    height, width = pixels.shape[0] // 2 * 2, pixels.shape[1] // 2 * 2
+    pixels = pixels[:height, :width].astype(numpy.uint16)
+    total = pixels[0::2, 0::2] + pixels[1::2, 0::2]\
+            + pixels[0::2, 1::2] + pixels[1::2, 1::2]
+    return ((total + 2) // 4).astype(numpy.uint8)
+
+@instrument.timed("pyramid")
+def level_pixels(path, level):
+    '''
+        Returns the pixelbuffer.PixelBuffer of a level of a picture file.
+    '''
+    if level == 0:
+        return pixelbuffer.from_file(path)
+    pixels = pixelbuffer.from_file(path).rgb()
+    for i in xrange(level):
+        pixels = reduce(pixels)
+    return pixelbuffer.from_image(Image.fromarray(pixels, 'RGB'))
+
+def to_level(point, level):
+    '''
+        Returns the pixel of a level that a point of the picture is in.
+    '''
+    return (point[0] >> level, point[1] >> level)
+
+def from_level(point, level):
+    '''
+        Returns the point of the picture in the middle of a pixel of a level.
+    '''
+    half = (1 << level) >> 1
+    return ((point[0] << level) + half, (point[1] << level) + half)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+    Compact storage for selected areas of a picture.
+
+    An Area keeps only the bounding box of its pixels and one bit per pixel
+    of that box, packed eight to a byte. That is about an eighth of a byte
+    per pixel instead of the hundred or so a list of (x,y) tuples costs,
+    and asking whether a point is in the area is a single bit lookup.
+'''
+
+import numpy
+
+class Area:
+    '''
+        A set of pixels in a picture of the given width and height.
+        Box is (left, top, right, bottom), with right and bottom just past
+        the last column and row. Bits holds the box row by row,
+        packed with numpy.packbits.
+    '''
+    def __init__(self, width, height, box=(0, 0, 0, 0), bits=None, count=0):
+        self.width, self.height = width, height
+        self.box = box
+        if bits is None:
+            bits = numpy.zeros(0, numpy.uint8)
+        self.bits = bits
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, point):
+        x, y = point
+        left, top, right, bottom = self.box
+        if x < left or x >= right or y < top or y >= bottom:
+            return False
+        i = (y - top) * (right - left) + (x - left)
+        return bool((self.bits[i >> 3] >> (7 - (i & 7))) & 1)
+
+    def boxMask(self):
+        '''
+            Returns the pixels of the bounding box as a boolean array.
+        '''
+        left, top, right, bottom = self.box
+        size = (right - left) * (bottom - top)
+        bits = numpy.unpackbits(self.bits)[:size]
+        return bits.astype(bool).reshape(bottom - top, right - left)
+
+    def placed(self, box):
+        '''
+            Returns the pixels of the area that fall inside another box
+            as a boolean array the size of that box.
+        '''
+        left, top, right, bottom = box
+        out = numpy.zeros((bottom - top, right - left), bool)
+        l, t, r, b = self.box
+        cl, ct = max(l, left), max(t, top)
+        cr, cb = min(r, right), min(b, bottom)
+        if cl < cr and ct < cb:
+            out[ct-top:cb-top, cl-left:cr-left] = \
+                self.boxMask()[ct-t:cb-t, cl-l:cr-l]
+        return out
+
+    def mask(self):
+        '''
+            Returns the area as a boolean mask of the whole picture.
+        '''
+        return self.placed((0, 0, self.width, self.height))
+
+    def pixels(self, array):
+        '''
+            Returns the entries of a height x width (x channels) array
+            that are in the area, going across and down.
+        '''
+        left, top, right, bottom = self.box
+        return array[top:bottom, left:right][self.boxMask()]
+
+    def paint(self, array, value):
+        '''
+            Sets the entries of a height x width (x channels) array that
+            are in the area to value.
+        '''
+        left, top, right, bottom = self.box
+        array[top:bottom, left:right][self.boxMask()] = value
+
+    def union(self, other):
+        '''
+            Returns a new area with the pixels of both areas.
+        '''
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+        box = (min(self.box[0], other.box[0]), min(self.box[1], other.box[1]),
+               max(self.box[2], other.box[2]), max(self.box[3], other.box[3]))
+        return from_box_mask(self.placed(box) | other.placed(box), box,
+                             self.width, self.height)
+
+    def difference(self, other):
+        '''
+            Returns a new area with the pixels of this area
+            that are not in the other one.
+        '''
+        if not self.count or not other.count:
+            return self
+        return from_box_mask(self.boxMask() & ~other.placed(self.box),
+                             self.box, self.width, self.height)
+
+def from_box_mask(mask, box, width, height):
+    '''
+        Makes an area from a boolean array covering box in a picture of
+        the given size, trimming the box down to the pixels that are set.
+    '''
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return Area(width, height)
+
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    mask = mask[top:bottom, left:right]
+    box = (int(box[0] + left), int(box[1] + top),
+           int(box[0] + right), int(box[1] + bottom))
+    return Area(width, height, box, numpy.packbits(mask.ravel()),
+                int(mask.sum()))
+
+def from_mask(mask):
+    '''
+        Makes an area from a boolean mask of the whole picture.
+    '''
+    height, width = mask.shape
+    return from_box_mask(mask, (0, 0, width, height), width, height)
+
+def from_pixels(pixels, width, height):
+    '''
+        Makes an area from an array of flat pixel indices (x + y * width).
+        Only the bounding box of the pixels is ever filled in.
+    '''
+    if not len(pixels):
+        return Area(width, height)
+
+    ys, xs = pixels // width, pixels % width
+    left, top = int(xs.min()), int(ys.min())
+    right, bottom = int(xs.max()) + 1, int(ys.max()) + 1
+    mask = numpy.zeros((bottom - top, right - left), bool)
+    mask[ys - top, xs - left] = True
+    return Area(width, height, (left, top, right, bottom),
+                numpy.packbits(mask.ravel()), int(mask.sum()))
+
+def from_points(points, width, height):
+    '''
+        Makes an area from a list of (x,y) points,
+        the way areas used to be stored.
+    '''
+    if not len(points):
+        return Area(width, height)
+    xs, ys = zip(*points)
+    pixels = numpy.array(xs, int) + numpy.array(ys, int) * width
+    return from_pixels(numpy.unique(pixels), width, height)
+
+def box_union(first, second):
+    '''
+        Returns the box around two boxes, either of which may be None.
+    '''
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (min(first[0], second[0]), min(first[1], second[1]),
+            max(first[2], second[2]), max(first[3], second[3]))
+
+def union_all(areas):
+    '''
+        Returns the union of a list of areas of the same picture.
+    '''
+    total = areas[0]
+    for other in areas[1:]:
+        total = total.union(other)
+    return total
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+'''
+    Reading and writing EasierTrain session (.et) files.
+
+    A session is the palette and the thresholds:
+        [ [ [ { picture_path : Area } , average_color_tuple , colorname,
+                histogram ] ],
+          { picture_path : threshold } ]
+    This is kept apart from the GUI so a session can be turned into
+    .tm/.col files without Tkinter, see etbatch.py.
+
+    Session files are binary, all numbers little-endian:
+        header      MAGIC, VERSION, number of pictures, number of colors
+                    and where the data block starts
+        pictures    for each picture its size and threshold (-1 if it has
+                    none), then its path
+        colors      for each color its average color, pixel count, shape
+                    and place of its histogram, number of areas and name,
+                    then for each area the index of its picture, its box,
+                    pixel count and place of its bits
+        data        the packed bits of every regions.Area as they are,
+                    and the histograms as their nonzero bins and counts
+    The data block is memory-mapped when a session is loaded, so the
+    palette is there at once and the bits of an area are only read from
+    the file when the area is first used, or when the session is saved
+    over the file it was loaded from.
+
+    Sessions used to be pickled. load() still reads those, and save() only
+    writes the new format, so saving an old session converts it.
+'''
+
+import os
+import struct
+import pickle # older sessions
+import tempfile
+import numpy
+import Image # PIL
+import regions
+import instrument
+
+MAGIC = "ETSESSN\n"
+VERSION = 1
+
+HEADER = "<8sHIIQ"  # magic, version, pictures, colors, data offset
+PICTURE = "<IIiH"   # width, height, threshold, path length
+COLOR = "<3BQ3HQIIH" # r, g, b, pixels, histogram shape, histogram offset,
+                     # nonzero bins, areas, name length
+AREA = "<I4IQQI"    # picture, box, pixels, bits offset, bits length
+
+@instrument.timed("session save")
+def save(filename, colors, thresholds):
+    '''
+        Writes the palette and thresholds to filename.
+        The file is written next to it first and moved into place. Areas
+        that are still memory-mapped from filename are read into memory
+        before that, as a mapped file can't be removed on Windows.
+    '''
+    paths = set(thresholds)
+    for color_data in colors:
+        paths.update(color_data[0])
+    paths = sorted(paths)
+    index = dict([(path, i) for i, path in enumerate(paths)])
+
+    sizes = dict()
+    for color_data in colors:
+        for path, area in color_data[0].items():
+            sizes[path] = (area.width, area.height)
+
+    tables = []
+    data = []
+    offset = 0
+    for path in paths:
+        width, height = sizes.get(path, (0, 0))
+        tables.append(struct.pack(PICTURE, width, height,
+                                  thresholds.get(path, -1), len(path)))
+        tables.append(path)
+
+    for color_data in colors:
+        areas, color, name = color_data[:3]
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+
+        shape, bins = (0, 0, 0), 0
+        histogram = offset
+        if len(color_data) > 3:
+            hist = color_data[3]
+            shape = hist.shape
+            nonzero = numpy.flatnonzero(hist).astype("<u4")
+            bins = len(nonzero)
+            data.append(nonzero.tostring())
+            data.append(hist.ravel()[nonzero].astype("<u4").tostring())
+            offset += 8 * bins
+
+        pixels = 0
+        for area in areas.values():
+            pixels += len(area)
+        tables.append(struct.pack(COLOR, color[0], color[1], color[2],
+                                  pixels, shape[0], shape[1], shape[2],
+                                  histogram, bins, len(areas), len(name)))
+        tables.append(name)
+
+        for path in sorted(areas):
+            area = areas[path]
+            bits = numpy.asarray(area.bits, numpy.uint8).tostring()
+            left, top, right, bottom = area.box
+            tables.append(struct.pack(AREA, index[path], left, top, right,
+                                      bottom, len(area), offset, len(bits)))
+            data.append(bits)
+            offset += len(bits)
+
+    tables = "".join(tables)
+    header = struct.pack(HEADER, MAGIC, VERSION, len(paths), len(colors),
+                         struct.calcsize(HEADER) + len(tables))
+
+    temp = None
+    try:
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, temp = tempfile.mkstemp(".et", "", directory)
+        out = os.fdopen(handle, "wb")
+        try:
+            out.write(header)
+            out.write(tables)
+            for block in data:
+                out.write(block)
+        finally:
+            out.close()
+
+        unmap(colors, filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+
+    except(IOError, OSError):
+        print "Failed to write", filename
+        if temp is not None and os.path.exists(temp):
+            os.remove(temp)
+
+@instrument.timed("session load")
+def load(filename, imgdir=None):
+    '''
+        Reads a session file and returns (colors, thresholds).
+        If imgdir is given the pictures are looked for there, see relocate().
+    '''
+    head = open(filename, "rb").read(len(MAGIC))
+    if head != MAGIC:
+        return read_pickle(filename, imgdir)
+
+    colors, thresholds = read(filename)
+    if imgdir is not None:
+        thresholds = relocate(colors, thresholds, imgdir)
+
+    return colors, thresholds
+
+def read(filename):
+    '''
+        Reads a session in the binary format. The bits of the areas and
+        the histograms stay in the memory-mapped file until they're used.
+    '''
+    mapped = numpy.memmap(filename, numpy.uint8, "r")
+    position = [0]
+    def unpack(layout):
+        size = struct.calcsize(layout)
+        fields = struct.unpack(layout,
+                               mapped[position[0]:position[0] + size].tostring())
+        position[0] += size
+        return fields
+    def string(length):
+        text = mapped[position[0]:position[0] + length].tostring()
+        position[0] += length
+        return text
+
+    magic, version, pictures, count, start = unpack(HEADER)
+    if version > VERSION:
+        raise IOError("%s is from a newer EasierTrain (version %d)"
+                      % (filename, version))
+
+    thresholds = dict()
+    paths, sizes = [], []
+    for i in xrange(pictures):
+        width, height, threshold, length = unpack(PICTURE)
+        path = string(length)
+        paths.append(path)
+        sizes.append((width, height))
+        if threshold >= 0:
+            thresholds[path] = threshold
+
+    colors = []
+    for i in xrange(count):
+        r, g, b, pixels, y, u, v, histogram, bins, areas, length\
+            = unpack(COLOR)
+        name = string(length)
+
+        selected = dict()
+        for j in xrange(areas):
+            picture, left, top, right, bottom, size, offset, nbytes\
+                = unpack(AREA)
+            width, height = sizes[picture]
+            bits = mapped[start + offset:start + offset + nbytes]
+            selected[paths[picture]] = regions.Area(width, height,
+                (left, top, right, bottom), bits, size)
+
+        color_data = [selected, (r, g, b), name]
+        if y:
+            nonzero = start + histogram
+            counts = nonzero + 4 * bins
+            hist = numpy.zeros((y, u, v), numpy.uint32)
+            hist.flat[mapped[nonzero:counts].view("<u4")]\
+                = mapped[counts:counts + 4 * bins].view("<u4")
+            color_data.append(hist)
+        colors.append(color_data)
+
+    return colors, thresholds
+
+def unmap(colors, filename):
+    '''
+        Reads the bits of the areas that are memory-mapped from filename
+        into memory, so the file is no longer mapped once they are the
+        only ones that used it.
+    '''
+    filename = os.path.abspath(filename)
+    for color_data in colors:
+        for area in color_data[0].values():
+            if isinstance(area.bits, numpy.memmap)\
+               and os.path.abspath(area.bits.filename) == filename:
+                area.bits = numpy.array(area.bits)
+
+def read_pickle(filename, imgdir=None):
+    '''
+        Reads a session that was pickled by an older EasierTrain, with
+        its pictures looked for in imgdir if given, see relocate().
+    '''
+    deserialized = pickle.load(open(filename, "r"))
+
+    colors = deserialized[0]
+    thresholds = deserialized[1]
+
+    if imgdir is not None:
+        thresholds = relocate(colors, thresholds, imgdir)
+
+    # Older sessions stored a list of lists of (x,y) points per picture.
+    # Making an Area of them needs the size of the picture, so the areas
+    # of pictures that can't be opened are left out.
+    for color_data in colors:
+        for path, areas in color_data[0].items():
+            if isinstance(areas, list):
+                try:
+                    w, h = Image.open( path ).size
+                except(IOError):
+                    print "Can't open", path, "so its areas are left out"
+                    del color_data[0][path]
+                    continue
+                color_data[0][path] = regions.from_points(\
+                    [point for points in areas for point in points], w, h)
+
+    return colors, thresholds
+
+def relocate(colors, thresholds, imgdir):
+    '''
+        Points the pictures of a session at imgdir, for sessions saved on
+        another machine or from another directory. Pictures are matched by
+        file name; ones that aren't in imgdir keep their old path.
+    '''
+    def moved(path):
+        newpath = os.path.join(imgdir, os.path.basename(path))
+        if os.path.isfile(newpath):
+            return newpath
+        return path
+
+    for color_data in colors:
+        areas = color_data[0]
+        color_data[0] = dict([(moved(path), areas[path]) for path in areas])
+
+    return dict([(moved(path), thresholds[path]) for path in thresholds])
+
+if __name__ == "__main__":
+    # Converts older, pickled sessions: python session.py old.et [new.et]
+    import sys
+    if len(sys.argv) not in (2, 3):
+        print "usage: python session.py <old.et> [<new.et>]"
+        sys.exit(2)
+    colors, thresholds = load(sys.argv[1])
+    save(sys.argv[-1], colors, thresholds)
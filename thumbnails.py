@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+    Thumbnail browser for jumping straight to any picture.
+
+    The browser is a scrolling grid of thumbnails of all the pictures in the
+    image directory. Only the rows in view have canvas items and PhotoImages,
+    so a directory of thousands of frames costs no more than a screenful.
+    Thumbnails are made on a background thread and kept on disk, named after
+    the SHA-1 digest of the picture like the field cache, so they only have
+    to be made once. Clicking a thumbnail shows that picture in the main
+    window without loading any of the ones in between.
+'''
+
+import os
+import Tkinter as tk
+import ImageTk
+import Image # PIL
+import numpy
+import fieldcache
+import workers
+
+# Largest thumbnail, and the space around each one
+SIZE = (96, 72)
+PAD = 4
+
+# Thumbnails across, and rows shown when the window opens
+COLUMNS = 4
+ROWS = 6
+
+# How often the browser checks for new thumbnails, in milliseconds
+POLL = 50
+
+# Where thumbnails are kept and how much room they may take, in bytes
+DIRECTORY = os.path.join(os.path.expanduser("~"), ".easiertrain", "thumbs")
+LIMIT = 64 * 1024 * 1024
+
+cache = fieldcache.FieldCache(DIRECTORY, LIMIT)
+
+def thumbnail(path):
+    '''
+        Returns a thumbnail of a picture, no bigger than SIZE, as a PIL image.
+        Made from the picture the first time and from the cache after that.
+    '''
+    key = fieldcache.file_key(path)
+    name = "thumb%dx%d" % SIZE
+    pixels = cache.load(key, name)
+    if pixels is None:
+        img = Image.open(path)
+        img.draft('RGB', SIZE) # JPEGs can be decoded at a fraction of the size
+        img = img.convert('RGB')
+        img.thumbnail(SIZE, Image.ANTIALIAS)
+        pixels = numpy.asarray(img)
+        cache.save(key, name, pixels)
+    return Image.fromarray(numpy.array(pixels))
+
+class ThumbnailBrowser(tk.Toplevel):
+    '''
+        Window with the thumbnails of app.imgpaths. The current picture of
+        app has a rectangle around it.
+    '''
+    def __init__(self, app):
+        tk.Toplevel.__init__(self)
+        self.app = app
+        self.title("Pictures")
+
+        self.cellw, self.cellh = SIZE[0] + 2*PAD, SIZE[1] + 2*PAD
+
+        self.canvas = tk.Canvas(self, width=COLUMNS*self.cellw,\
+                                height=ROWS*self.cellh)
+        self.scrollbar = tk.Scrollbar(self, orient='vertical',\
+                                      command=self.OnScroll)
+        self.canvas.config(yscrollcommand=self.scrollbar.set)
+        self.canvas.grid(column=0, row=0, sticky='NSEW')
+        self.scrollbar.grid(column=1, row=0, sticky='NS')
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        self.canvas.bind("<Button-1>", self.OnThumbnailClick)
+        self.canvas.bind("<Configure>", self.OnResize)
+        self.canvas.bind("<MouseWheel>", self.OnWheel)
+        self.canvas.bind("<Button-4>", self.OnWheel)
+        self.canvas.bind("<Button-5>", self.OnWheel)
+        self.protocol("WM_DELETE_WINDOW", self.OnClose)
+
+        self.loader = workers.WorkerPool(1)
+        self.ready = dict() # path : thumbnail made by the loader, not shown
+        self.items = dict() # index : (path, canvas item, PhotoImage)
+        self.shown = [] # indices of the thumbnails in view
+        self.count = 0 # pictures the scroll region was made for
+        self.current = None # index the marker was put around
+
+        self.marker = self.canvas.create_rectangle(0, 0, 0, 0,\
+                                                   outline='red', width=2)
+        self.polling = None
+        self.poll()
+
+    def visible(self):
+        '''
+            Returns the indices of the thumbnails in rows that are in view.
+        '''
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first = int(top // self.cellh) * COLUMNS
+        last = (int(bottom // self.cellh) + 1) * COLUMNS
+        return range(max(0, first), min(self.count, last))
+
+    def cell(self, index):
+        '''
+            Returns the (left, top) corner of the cell of a thumbnail.
+        '''
+        return (index % COLUMNS) * self.cellw, (index // COLUMNS) * self.cellh
+
+    def drawThumbnails(self):
+        '''
+            Shows the thumbnails of the rows in view and lets go of the rest.
+            Thumbnails that aren't made yet are handed to the loader.
+        '''
+        paths = self.app.imgpaths
+        if len(paths) != self.count:
+            # more pictures were found, or one was dropped
+            self.count = len(paths)
+            rows = (self.count + COLUMNS - 1) // COLUMNS
+            self.canvas.config(scrollregion=(0, 0, COLUMNS*self.cellw,\
+                                             rows*self.cellh))
+
+        shown = self.visible()
+        for index in self.items.keys():
+            path, item, photo = self.items[index]
+            if index not in shown or index >= len(paths)\
+               or paths[index] != path:
+                self.canvas.delete(item)
+                del self.items[index]
+
+        # Only what is in view is worth making
+        wanted = [paths[index] for index in shown]
+        for path in self.ready.keys():
+            if path not in wanted:
+                del self.ready[path]
+        if shown != self.shown:
+            self.shown = shown
+            self.loader.cancel()
+            for index in shown:
+                if index not in self.items and paths[index] not in self.ready:
+                    self.loader.submit(self.load, paths[index],\
+                                       self.loader.generation)
+
+        for index in shown:
+            if index in self.items or paths[index] not in self.ready:
+                continue
+            photo = ImageTk.PhotoImage(self.ready.pop(paths[index]))
+            left, top = self.cell(index)
+            item = self.canvas.create_image(left + self.cellw/2,\
+                                            top + self.cellh/2, image=photo)
+            self.items[index] = (paths[index], item, photo)
+
+        # Put the marker around the current picture
+        self.current = self.app.img_index
+        left, top = self.cell(self.current)
+        self.canvas.coords(self.marker, left + 1, top + 1,\
+                           left + self.cellw - 1, top + self.cellh - 1)
+        self.canvas.tag_raise(self.marker)
+
+    def load(self, path, generation):
+        '''
+            Makes a thumbnail on the loader thread. It is put in self.ready
+            for drawThumbnails(), as widgets can't be touched from here,
+            unless the view has moved on in the meantime.
+        '''
+        try:
+            img = thumbnail(path)
+        except(IOError):
+            return # not a picture after all
+        if not self.loader.cancelled(generation):
+            self.ready[path] = img
+
+    def poll(self):
+        '''
+            Draws the thumbnails again whenever new ones are ready, more
+            pictures have been found or the current picture has changed.
+        '''
+        if self.ready or len(self.app.imgpaths) != self.count\
+           or self.app.img_index != self.current:
+            self.drawThumbnails()
+        self.polling = self.after(POLL, self.poll)
+
+    def OnScroll(self, *args):
+        self.canvas.yview(*args)
+        self.drawThumbnails()
+
+    def OnWheel(self, event):
+        if event.num == 5 or getattr(event, 'delta', 0) < 0:
+            self.canvas.yview_scroll(1, 'units')
+        else:
+            self.canvas.yview_scroll(-1, 'units')
+        self.drawThumbnails()
+
+    def OnResize(self, event):
+        self.drawThumbnails()
+
+    def OnThumbnailClick(self, event):
+        '''
+            Shows the picture that was clicked on in the main window.
+        '''
+        column = int(self.canvas.canvasx(event.x) // self.cellw)
+        row = int(self.canvas.canvasy(event.y) // self.cellh)
+        index = row * COLUMNS + column
+        if column < COLUMNS and index < len(self.app.imgpaths):
+            self.app.GoTo(index)
+            self.drawThumbnails()
+
+    def OnClose(self):
+        self.after_cancel(self.polling)
+        self.loader.cancel()
+        self.app.browser = None
+        self.destroy()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+    Background threads for work the GUI shouldn't wait on.
+
+    Jobs are plain function calls, handed to a few daemon threads through
+    a queue. Cancelling doesn't stop a job that is already running, but every
+    job that hasn't started yet is skipped, and jobs can check whether they
+    were cancelled before they hand over their results.
+
+    Tkinter may only be used from the thread running mainloop, so jobs must
+    never touch widgets. They leave their results where the GUI looks for
+    them instead, or are run as tasks of a TaskRunner, whose results are
+    handed back to the GUI thread through a queue.
+'''
+
+import sys
+import threading
+import traceback
+import Queue
+
+class WorkerPool:
+    '''
+        A queue of jobs and the threads working through it.
+    '''
+    def __init__(self, threads=2):
+        self.jobs = Queue.Queue()
+        self.generation = 0 # goes up every time the jobs are cancelled
+        self.threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True) # don't keep the program from quitting
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        '''
+            Queues func(*args) to be run on one of the threads.
+            Returns the generation of the job, see cancelled().
+        '''
+        self.jobs.put((self.generation, func, args))
+        return self.generation
+
+    def cancel(self):
+        '''
+            Cancels every job submitted so far.
+        '''
+        self.generation += 1
+
+    def cancelled(self, generation):
+        '''
+            Tells whether jobs of that generation have been cancelled.
+        '''
+        return generation != self.generation
+
+    def work(self):
+        '''
+            Runs jobs as they come, for as long as the program does.
+        '''
+        while True:
+            generation, func, args = self.jobs.get()
+            if self.cancelled(generation):
+                continue
+            try:
+                func(*args)
+            except Exception:
+                # A failed job shouldn't take the thread down with it
+                traceback.print_exc(file=sys.stderr)
+
+class Cancelled(Exception):
+    '''
+        Raised by Task.progress() to stop the work of a cancelled task.
+    '''
+    pass
+
+class Task:
+    '''
+        Work for a TaskRunner: work(progress, *args) runs in the background,
+        then done(result) runs on the GUI thread, unless the task was
+        cancelled in the meantime.
+    '''
+    def __init__(self, text, work, done, args):
+        self.text = text
+        self.work = work
+        self.done = done
+        self.args = args
+        self.fraction = 0.0
+        self.cancelled = False
+
+    def progress(self, fraction):
+        '''
+            Passed to the work to say how far along it is. Stops the work,
+            by raising Cancelled, if the task has been cancelled.
+        '''
+        if self.cancelled:
+            raise Cancelled()
+        self.fraction = fraction
+
+    def cancel(self):
+        self.cancelled = True
+
+class TaskRunner:
+    '''
+        Runs tasks on background threads and hands their results back to
+        the GUI thread, which has to call deliver() every so often.
+    '''
+    def __init__(self, threads=1):
+        self.pool = WorkerPool(threads)
+        self.results = Queue.Queue()
+        self.running = [] # tasks started and not delivered yet
+
+    def start(self, text, work, done, *args):
+        '''
+            Starts a task and returns it. Text says what it is doing.
+        '''
+        task = Task(text, work, done, args)
+        self.running.append(task)
+        self.pool.submit(self.run, task)
+        return task
+
+    def run(self, task):
+        '''
+            Runs the work of a task on a worker thread.
+        '''
+        result, finished = None, False
+        try:
+            if not task.cancelled:
+                result = task.work(task.progress, *task.args)
+                finished = True
+        except Cancelled:
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        self.results.put((task, result, finished))
+
+    def deliver(self):
+        '''
+            Calls done() for every task that has finished and wasn't
+            cancelled. Only ever call this from the GUI thread.
+        '''
+        while True:
+            try:
+                task, result, finished = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self.running.remove(task)
+            if finished and not task.cancelled:
+                task.done(result)
+
+    def cancel(self):
+        '''
+            Cancels every task that is running or waiting to run.
+        '''
+        for task in self.running:
+            task.cancel()
+
+    def status(self):
+        '''
+            Returns a line about the tasks that are running, or "" if none.
+        '''
+        running = [task for task in self.running if not task.cancelled]
+        if not running:
+            return ""
+        task = running[0]
+        text = "%s... %d%%" % (task.text, int(task.fraction * 100))
+        if len(running) > 1:
+            text += " (+%d more)" % (len(running) - 1)
+        return text